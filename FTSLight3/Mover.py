@@ -258,6 +258,10 @@ class Configuration(object):
         ]
 
         self.ScanRecursive = config.get("Scanner", "Recursive", "no") == "yes"
+        max_depth = config.get("Scanner", "MaxDepth", None)               # default - unlimited
+        self.ScanMaxDepth = int(max_depth) if max_depth is not None else None
+        self.ScanWorkers = int(config.get("Scanner", "ScanWorkers", 5))      # directories listed in parallel
+        self.ScanMTimeCache = config.get("Scanner", "MTimeCache", "no") == "yes"
 
         prescale = float(config.get("Scanner", "PrescaleFactor", "1.0"))
         # round to nearest 1/100th
@@ -280,7 +284,7 @@ class Configuration(object):
         self.PathRE = config.get("Scanner", "PathRE", "[^ ]+$")
         self.SizeRE = config.get("Scanner", "SizeRE", "^[a-z-]+\s+[0-9-]+\s+\d\d:\d\d:\d\d\s*(?P<size>\d+)")
         self.ParseRE = config.get("Scanner", "ParseRE", "^(?P<type>[a-z-])\S+\s+\d+\s+\w+\s+\w+\s+(?P<size>\d+)\s+.+\s+(?P<path>\S+)$")
-        self.ScannerOperationTimeout = float(config.get("Scanner", "OperationTimeout", 10.0))
+        self.ScannerOperationTimeout = float(config.get("Scanner", "OperationTimeout", 10.0))     # per directory listing
         
         self.HTTPPort = int(config.get("Monitor", "HTTPPort", 8080))
         self.GUIPrefix = config.get("Monitor", "GUIPrefix", "/fts-light")
@@ -1,4 +1,4 @@
-from pythreader import PyThread, synchronized, Primitive
+from pythreader import PyThread, synchronized, Primitive, TaskQueue
 from threading import Event
 from tools import runCommand
 import time, fnmatch, re, traceback, sys
@@ -25,6 +25,112 @@ class FileDescriptor(object):
     __repr__ = __str__
     
 
+class DirectoryMTimeCache(Primitive):
+    #
+    # Remembers the files found in the leaf directories, keyed by the directory modification time
+    # shown in the parent directory listing. A leaf directory is not listed again while its mtime does not change.
+    # The cached listing is used only after two listings returned the same mtime, so that files created
+    # within the same second as the previous listing are not missed.
+    # Sizes of the files in a cached directory are the sizes seen by the last listing.
+    #
+
+    def __init__(self):
+        Primitive.__init__(self)
+        self.Entries = {}           # path -> (mtime, files, confirmed)
+
+    @synchronized
+    def get(self, path, mtime):
+        if mtime is None:
+            return None
+        cached_mtime, files, confirmed = self.Entries.get(path, (None, None, False))
+        if confirmed and cached_mtime == mtime:
+            return files
+        return None
+
+    @synchronized
+    def put(self, path, mtime, files, dirs):
+        if mtime is None or dirs:
+            # only leaf directories can be cached: changes in the subdirectories do not change the directory mtime
+            self.Entries.pop(path, None)
+        else:
+            cached_mtime, _, _ = self.Entries.get(path, (None, None, False))
+            self.Entries[path] = (mtime, files, cached_mtime == mtime)
+
+    @synchronized
+    def retain(self, paths):
+        # forget the directories which were not seen by the last scan
+        self.Entries = {path: entry for path, entry in self.Entries.items() if path in paths}
+
+
+class DirectoryWalk(Primitive, Logged):
+    #
+    # Walk of the directory tree under the location, listing up to nworkers directories in parallel.
+    # pythreader TaskQueue starts the most recently added listing first, so the walk goes mostly depth-first.
+    # Failed subdirectory listings are logged and skipped.
+    #
+
+    def __init__(self, scanner, nworkers, max_depth, timeout, mtime_cache=None):
+        Primitive.__init__(self)
+        Logged.__init__(self, name=f"DirectoryWalk({scanner.Server}:{scanner.Location})")
+        self.Scanner = scanner
+        self.MaxDepth = max_depth           # None - unlimited
+        self.Timeout = timeout
+        self.MTimeCache = mtime_cache
+        self.Queue = TaskQueue(nworkers)
+        self.Files = []
+        self.Visited = set()
+        self.NListed = self.NCached = self.NFailed = 0
+
+    @synchronized
+    def add_files(self, files):
+        self.Files += files
+
+    @synchronized
+    def add_dirs(self, dirs, depth):
+        # dirs: [(path, mtime), ...] at the given depth, the location itself is at depth 0
+        if self.MaxDepth is not None and depth > self.MaxDepth:
+            return
+        for path, mtime in dirs:
+            if path not in self.Visited:
+                self.Visited.add(path)
+                self.Queue.append(self.list_dir, path, mtime, depth)
+
+    def list_dir(self, path, mtime, depth):
+        files = self.MTimeCache.get(path, mtime) if self.MTimeCache is not None else None
+        if files is not None:
+            with self:
+                self.NCached += 1
+            self.add_files(files)
+            return
+        status, error, files, dirs = self.Scanner.listFilesAndDirs(path, self.Timeout)
+        if status:
+            with self:
+                self.NFailed += 1
+            self.log(f"Error listing {path}: {error}")
+            return
+        with self:
+            self.NListed += 1
+        if self.MTimeCache is not None:
+            self.MTimeCache.put(path, mtime, files, dirs)
+        self.add_files(files)
+        self.add_dirs(dirs, depth + 1)
+
+    def walk(self, location):
+        status, error, files, dirs = self.Scanner.listFilesAndDirs(location, self.Timeout)
+        if status:
+            return status, error, []
+        self.NListed += 1
+        self.Visited.add(location)
+        self.add_files(files)
+        self.add_dirs(dirs, 1)
+        self.Queue.waitUntilEmpty()
+        self.Queue.stop()
+        if self.MTimeCache is not None:
+            self.MTimeCache.retain(self.Visited)
+        self.log("directories listed:", self.NListed, "  cached:", self.NCached, "  failed:", self.NFailed)
+        return 0, "", self.Files
+
+
 class ScanManager(Primitive, Logged):
 
     def __init__(self, manager, history_db, config, held):
@@ -95,6 +201,9 @@ class Scanner(PyThread, Logged):
         self.PathRE = re.compile(config.PathRE)
         self.SizeRE = re.compile(config.SizeRE)
         self.Recursive = config.ScanRecursive
+        self.MaxDepth = config.ScanMaxDepth if self.Recursive else 0
+        self.ScanWorkers = config.ScanWorkers
+        self.MTimeCache = DirectoryMTimeCache() if config.ScanMTimeCache else None
         self.PrescaleFactor = int(config.ScanPrescale*self.PrescaleMultiplier)     # 100 means send all files
         self.PrescaleSalt = config.PrescaleSalt
         self.OperationTimeout = config.ScannerOperationTimeout
@@ -131,21 +240,14 @@ class Scanner(PyThread, Logged):
         return out, None
 
     def listFilesUnder(self, location):
-        out = []
-        status, error, files, dirs = self.listFilesAndDirs(location, self.OperationTimeout)
-        #self.debug("Files: %s" % (files,))
-        #self.debug("Dirs: %s" % (dirs,))
-        if status == 0:
-            out += files
-            if self.Recursive:
-                for path in dirs:
-                    st, err, files = self.listFilesUnder(path)
-                    if st == 0:
-                        out += files
-        return status, error, out
-
+        # returns status, error, files
+        walk = DirectoryWalk(self, self.ScanWorkers, self.MaxDepth, self.OperationTimeout, self.MTimeCache)
+        return walk.walk(location)
 
     def listFilesAndDirs(self, location, timeout):
+        # returns status, error, files, dirs
+        #   files: [FileDescriptor, ...]
+        #   dirs: [(path, mtime), ...], mtime is None unless ParseRE has the "mtime" group
         lscommand = self.lsCommandTemplate.replace("$location", location).replace("$server", self.Server)
         files = []
         dirs = []
@@ -170,7 +272,7 @@ class Scanner(PyThread, Logged):
                             files.append(FileDescriptor(self.Server, location, path, name, size))
                         elif t == "d": 
                             path = path if path.startswith(location) else location + "/" + path
-                            dirs.append(path)
+                            dirs.append((path, m.groupdict().get("mtime")))
                         else:
                             print(f"Unknown directory entry type '{t}' in: {l} -- ignored")
                     else:
@@ -197,17 +299,21 @@ class Scanner(PyThread, Logged):
     def run(self):
         while not self.Stop:
             if not self.Held and not self.Stop:
+                t0 = time.time()
                 try:
                     descs, error = self.scan()
                 except Exception as e:
                     descs = []
                     error = "scan() error: " + traceback.format_exc()
                     self.error(error)
+                    self.HistoryDB.add_scanner_record(self.Server, self.Location, time.time(), 0, 0, time.time() - t0, error)
                 else:
+                    duration = time.time() - t0
                     if error:
                         self.error(error)
+                        self.HistoryDB.add_scanner_record(self.Server, self.Location, time.time(), 0, 0, duration, error)
                     else:
                         nnew = self.Manager.addFiles(descs)
-                        self.log("found matching data+metadata pairs:", len(descs), "files,   new:", nnew)
-                        self.HistoryDB.add_scanner_record(self.Server, self.Location, time.time(), len(descs), nnew)
+                        self.log("found matching data+metadata pairs:", len(descs), "files,   new:", nnew, "   scan time: %.1f" % (duration,))
+                        self.HistoryDB.add_scanner_record(self.Server, self.Location, time.time(), len(descs), nnew, duration)
             self.sleep(self.ScanInterval)
@@ -2,13 +2,14 @@ import sqlite3, time
 from pythreader import Primitive, synchronized
 
 class _ScannerRecord(object):
-    def __init__(self, server, location, t, nfiles, nnew, error):
+    def __init__(self, server, location, t, nfiles, nnew, error, duration):
         self.Server = server
         self.Location = location
         self.T = t
         self.NFiles = nfiles
         self.NNew = nnew
         self.Error = error
+        self.Duration = duration
 
 class _HistoryDB(Primitive):
 
@@ -70,9 +71,14 @@ class _HistoryDB(Primitive):
                     nfiles      int,
                     nnew        int,
                     error       text,
+                    duration    float,
                     primary key(server, location, t)
                 )
             """)
+            columns = [row[1] for row in c.execute("pragma table_info(scanner_log)").fetchall()]
+            if "duration" not in columns:
+                c.execute("alter table scanner_log add column duration float")
+            conn.commit()
             
 
     @synchronized
@@ -94,11 +100,11 @@ class _HistoryDB(Primitive):
             conn.commit()
             
     @synchronized
-    def add_scanner_record(self, server, location, t, n, nnew):
+    def add_scanner_record(self, server, location, t, n, nnew, duration=None, error=None):
         with self.dbconn() as conn:
             c = conn.cursor()
-            c.execute("insert into scanner_log(server, location, t, nfiles, nnew) values(?,?,?,?,?)",
-                (server, location, t, n, nnew)
+            c.execute("insert into scanner_log(server, location, t, nfiles, nnew, duration, error) values(?,?,?,?,?,?,?)",
+                (server, location, t, n, nnew, duration, error)
             )
             conn.commit()
             
@@ -106,7 +112,7 @@ class _HistoryDB(Primitive):
     def scannerHistorySince(self, t=0):
         with self.dbconn() as conn:
             c = conn.cursor()
-            c.execute("""select server, location, t, nfiles, nnew, error
+            c.execute("""select server, location, t, nfiles, nnew, error, duration
                     from scanner_log 
                     where t >= ?
                     order by server, location, t""", (t,)
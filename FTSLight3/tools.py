@@ -8,14 +8,16 @@ def to_str(b):
 
 def runCommand(cmd, timeout=None, debug=None):
     if timeout is not None and timeout < 0: timeout = None
-    status, out, err = ShellCommand.execute(cmd, timeout=timeout)
+    try:
+        status, out, err = ShellCommand.execute(cmd, timeout=timeout)
+    except RuntimeError:
+        status, out, err = None, "", ""        # timed out, the subprocess was killed
     if debug:
         debug(f"runCommand({cmd}): status: %s [%s] [%s]" % (status, out, err))
         
     if not out: out = err
     
     if status is None:
-        cmd.kill()
         out = (out or "") + "\n subprocess timed out\n"
         status = 100
     
@@ -0,0 +1,159 @@
+from pythreader import PyThread, synchronized, Promise
+from logs import Logged
+from tools import FIFOTaskQueue
+import time, traceback, sys, threading
+
+class Batcher(PyThread, Logged):
+    """
+    Collects items submitted by concurrent threads and processes them in batches.
+    Items are grouped by key. A batch is flushed when it reaches MaxSize items or when its
+    oldest item has been waiting for MaxDelay seconds, whichever comes first.
+
+    Subclasses implement process_batch(key, items) returning a list of per-item results
+    in the same order as the items. A result, which is an Exception instance, is delivered
+    to the submitter as an exception.
+
+    With workers > 1, up to that many batches are processed concurrently. While all the workers are busy,
+    the items keep accumulating in the waiting batches.
+
+    The submitters block until their batch is processed, so a batch can not grow beyond the number of the
+    submitting threads. A thread which is going to submit an item can announce it with expecting(batcher).
+    Once all the announced items are submitted, the batches are flushed without waiting for MaxDelay.
+    """
+
+    DefaultMaxSize = 50
+    DefaultMaxDelay = 2.0           # seconds
+
+    def __init__(self, name, max_size=None, max_delay=None, workers=1):
+        PyThread.__init__(self, name=name, daemon=True)
+        Logged.__init__(self, name)
+        self.MaxSize = max(1, max_size or self.DefaultMaxSize)
+        self.MaxDelay = self.DefaultMaxDelay if max_delay is None else max_delay
+        self.FlushQueue = None
+        if workers > 1:
+            self.FlushQueue = FIFOTaskQueue(workers, capacity=workers, name=f"{name}.flush_queue")
+        self.Batches = {}           # key -> (t_first, [(item, promise), ...])
+        self.Expected = 0           # number of announced items not submitted yet
+        self.Expectations = threading.local()           # .Current - _Expectation of the thread
+        self.Stop = False
+
+    @synchronized
+    def submit(self, key, item):
+        if self.Stop:
+            raise RuntimeError(f"{self.Name} is stopped")
+        promise = Promise(data=item)
+        t0, batch = self.Batches.setdefault(key, (time.time(), []))
+        batch.append((item, promise))
+        expectation = getattr(self.Expectations, "Current", None)
+        promise.Announced = expectation is not None and not expectation.Submitted
+        if promise.Announced:
+            expectation.Submitted = True
+            self.Expected -= 1
+        if len(batch) == 1 or len(batch) >= self.MaxSize or self.all_submitted():
+            # new batch or a batch to flush now: the thread needs to re-calculate its sleep time
+            self.wakeup()
+        return promise
+
+    @synchronized
+    def expect(self, n):
+        self.Expected += n
+        self.wakeup()
+
+    @synchronized
+    def all_submitted(self):
+        # True if there are waiting items, all of them announced, and no more announced items to wait for
+        return bool(self.Batches) and self.Expected <= 0 \
+            and all(promise.Announced for _, batch in self.Batches.values() for _, promise in batch)
+
+    def stop(self):
+        self.Stop = True
+        self.wakeup()
+
+    @synchronized
+    def due_batches(self):
+        # returns [(key, [(item, promise), ...]), ...] ready to be flushed
+        now = time.time()
+        due = []
+        all_submitted = self.all_submitted()
+        for key, (t0, batch) in list(self.Batches.items()):
+            if self.Stop or all_submitted or len(batch) >= self.MaxSize or t0 + self.MaxDelay <= now:
+                due.append((key, batch[:self.MaxSize]))
+                rest = batch[self.MaxSize:]
+                if rest:
+                    self.Batches[key] = (now, rest)
+                else:
+                    del self.Batches[key]
+        return due
+
+    def flush(self, key, batch):
+        items = [item for item, _ in batch]
+        t0 = time.time()
+        try:
+            results = self.process_batch(key, items)
+            assert len(results) == len(items), "process_batch returned %d results for %d items" % (len(results), len(items))
+        except:
+            exc_type, exc_value, tb = sys.exc_info()
+            self.error("error processing batch of %d items for %s:" % (len(items), key), "".join(traceback.format_exc()))
+            for _, promise in batch:
+                promise.exception(exc_type, exc_value, tb)
+        else:
+            self.debug("batch of %d items for %s processed in %.3f seconds" % (len(items), key, time.time() - t0))
+            for (_, promise), result in zip(batch, results):
+                if isinstance(result, Exception):
+                    promise.exception(type(result), result, result.__traceback__)
+                else:
+                    promise.complete(result)
+
+    def run(self):
+        while True:
+            due = self.due_batches()
+            for key, batch in due:
+                if self.FlushQueue is not None:
+                    self.FlushQueue.append(self.flush, key, batch)         # blocks while all the workers are busy
+                else:
+                    self.flush(key, batch)
+            if self.Stop and not self.Batches:
+                if self.FlushQueue is not None:
+                    self.FlushQueue.drain()
+                break
+            if not due:
+                with self:
+                    # re-check under the lock so that a wakeup() from submit() is not missed
+                    if not self.Stop and not self.all_submitted() \
+                            and not any(len(b) >= self.MaxSize for _, b in self.Batches.values()):
+                        deadlines = [t0 + self.MaxDelay for t0, _ in self.Batches.values()]
+                        timeout = max(0.0, min(deadlines) - time.time()) if deadlines else None
+                        self.sleep(timeout)
+
+    # overridable
+    def process_batch(self, key, items):
+        raise NotImplementedError()
+
+
+class _Expectation(object):
+
+    def __init__(self, batcher):
+        self.Batcher = batcher
+        self.Submitted = False
+
+    def __enter__(self):
+        if self.Batcher is not None:
+            self.Batcher.Expectations.Current = self
+            self.Batcher.expect(1)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.Batcher is not None:
+            self.Batcher.Expectations.Current = None
+            if not self.Submitted:
+                self.Batcher.expect(-1)
+
+def expecting(batcher):
+    """
+    Context manager announcing that the calling thread is going to submit one item to the batcher, which may be None:
+
+        with expecting(batcher):
+            ...
+            batcher.submit(key, item).wait()
+    """
+    return _Expectation(batcher)
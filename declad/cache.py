@@ -0,0 +1,62 @@
+from pythreader import Primitive, synchronized
+from collections import OrderedDict
+import time
+
+class ExpiringCache(Primitive):
+    """
+    Thread-safe bounded cache with per-entry time-to-live. When the capacity is reached,
+    the least recently used entry is evicted.
+    """
+
+    def __init__(self, capacity=None, ttl=None, name=None):
+        Primitive.__init__(self, name=name)
+        self.Capacity = capacity
+        self.TTL = ttl
+        self.Data = OrderedDict()           # key -> (expiration time or None, value)
+
+    @synchronized
+    def get(self, key, default=None):
+        tup = self.Data.get(key)
+        if tup is None:
+            return default
+        expires, value = tup
+        if expires is not None and expires < time.time():
+            del self.Data[key]
+            return default
+        self.Data.move_to_end(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    @synchronized
+    def set(self, key, value=True, ttl=None):
+        ttl = ttl if ttl is not None else self.TTL
+        self.Data[key] = (None if ttl is None else time.time() + ttl, value)
+        self.Data.move_to_end(key)
+        if self.Capacity is not None:
+            while len(self.Data) > self.Capacity:
+                self.Data.popitem(last=False)
+
+    add = set
+
+    @synchronized
+    def remove(self, key):
+        return self.Data.pop(key, (None, None))[1]
+
+    @synchronized
+    def purge(self):
+        # removes expired entries
+        now = time.time()
+        expired = [key for key, (expires, _) in self.Data.items() if expires is not None and expires < now]
+        for key in expired:
+            del self.Data[key]
+        return len(expired)
+
+    @synchronized
+    def clear(self):
+        self.Data.clear()
+
+    @synchronized
+    def __len__(self):
+        return len(self.Data)
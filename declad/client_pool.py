@@ -0,0 +1,71 @@
+from pythreader import Primitive, synchronized
+from threading import RLock
+
+class ClientPool(Primitive):
+    """
+    Thread-safe pool of reusable client objects. Clients are created lazily by the factory function
+    up to the pool size. If all clients are in use, client() blocks until one is returned to the pool.
+
+        with pool.client() as c:
+            c.do_something()
+    """
+
+    class _Checkout(object):
+
+        def __init__(self, pool):
+            self.Pool = pool
+            self.Client = None
+
+        def __enter__(self):
+            self.Client = self.Pool.get()
+            return self.Client
+
+        def __exit__(self, exc_type, exc_value, traceback):
+            self.Pool.put(self.Client)
+            self.Client = None
+
+    def __init__(self, factory, size=1, name=None):
+        Primitive.__init__(self, name=name)
+        self.Factory = factory
+        self.Size = max(1, size)
+        self.Idle = []
+        self.NCreated = 0
+
+    @synchronized
+    def get(self):
+        while not self.Idle and self.NCreated >= self.Size:
+            self.sleep()
+        if self.Idle:
+            return self.Idle.pop()
+        self.NCreated += 1
+        try:
+            with self.unlock:
+                # creating a client may take a while, e.g. to authenticate
+                return self.Factory()
+        except:
+            self.NCreated -= 1
+            self.wakeup()
+            raise
+
+    @synchronized
+    def put(self, client):
+        if client is not None:
+            self.Idle.append(client)
+        self.wakeup()
+
+    def client(self):
+        return self._Checkout(self)
+
+_Registry = {}          # key -> shared object
+_RegistryLock = RLock()
+
+def shared(key, factory):
+    """
+    Returns the process-wide object registered under the key, creating it with the factory function
+    when called for the first time.
+    """
+    with _RegistryLock:
+        obj = _Registry.get(key)
+        if obj is None:
+            obj = _Registry[key] = factory()
+        return obj
@@ -0,0 +1,107 @@
+from pythreader import PyThread, synchronized
+from logs import Logged
+from collections import deque
+import time
+
+class ConcurrencyController(PyThread, Logged):
+    """
+    Adjusts the number of workers of a FIFOTaskQueue at run time using AIMD: the number of workers is increased by
+    a fixed step while the queue has waiting tasks and the transfers look healthy, and is multiplied by the decrease
+    factor when the error rate, the transfer latency or the aggregate throughput show that the storage is overloaded.
+
+    Observations are reported with record() for each completed transfer and evaluated every interval.
+    """
+
+    DefaultInterval = 60
+    DefaultIncrease = 1
+    DefaultDecrease = 0.7
+    DefaultMaxErrorRate = 0.1
+    DefaultLatencyFactor = 2.0
+    DefaultThroughputTolerance = 0.1
+    MinSamples = 3
+    MaxDecisions = 100
+
+    def __init__(self, queue, config, initial, backlog=None):
+        # config is the "adaptive_concurrency" section of the declad configuration
+        # backlog: if not None, the queue capacity is kept at the number of workers + backlog
+        PyThread.__init__(self, name="ConcurrencyController", daemon=True)
+        Logged.__init__(self, "ConcurrencyController")
+        self.Queue = queue
+        self.Backlog = backlog
+        self.Min = max(1, config.get("min", 1))
+        self.Max = max(self.Min, config.get("max", max(initial, 100)))
+        self.Interval = config.get("interval", self.DefaultInterval)
+        self.Increase = config.get("increase", self.DefaultIncrease)
+        self.Decrease = config.get("decrease", self.DefaultDecrease)
+        self.MaxErrorRate = config.get("max_error_rate", self.DefaultMaxErrorRate)
+        self.LatencyFactor = config.get("latency_factor", self.DefaultLatencyFactor)
+        self.ThroughputTolerance = config.get("throughput_tolerance", self.DefaultThroughputTolerance)
+        self.Current = min(self.Max, max(self.Min, initial))
+        self.Samples = []                       # [(duration, nbytes, ok), ...] since last adjustment
+        self.BaselineLatency = None             # best median seconds per MB seen so far, slowly relaxed
+        self.LastThroughput = None
+        self.LastIncreased = False
+        self.Decisions = deque(maxlen=self.MaxDecisions)      # [dict(t=, old=, new=, reason=, ...), ...]
+        self.Stop = False
+        self.set_workers(self.Current)
+
+    def set_workers(self, n):
+        # the queue capacity limits the number of running tasks too
+        self.Queue.resize(n, None if self.Backlog is None else n + self.Backlog)
+
+    @synchronized
+    def record(self, duration, nbytes, ok):
+        self.Samples.append((duration, nbytes, ok))
+
+    @synchronized
+    def decisions(self):
+        return list(self.Decisions)
+
+    def stop(self):
+        self.Stop = True
+        self.wakeup()
+
+    @synchronized
+    def adjust(self):
+        samples, self.Samples = self.Samples, []
+        nwaiting = self.Queue.nwaiting()
+        old = self.Current
+        nerrors = sum(1 for _, _, ok in samples if not ok)
+        good = [(duration, nbytes) for duration, nbytes, ok in samples if ok]
+        error_rate = nerrors/len(samples) if samples else 0.0
+        throughput = sum(nbytes for _, nbytes in good)/self.Interval
+        latencies = sorted(duration/max(nbytes/1e6, 1.0) for duration, nbytes in good)
+        latency = latencies[len(latencies)//2] if latencies else None
+
+        if latency is not None:
+            if self.BaselineLatency is None or latency < self.BaselineLatency:
+                self.BaselineLatency = latency
+            else:
+                self.BaselineLatency *= 1.01        # let the baseline follow slow changes
+
+        new, reason = old, "no change"
+        if len(samples) >= self.MinSamples and error_rate > self.MaxErrorRate:
+            new, reason = int(old * self.Decrease), "error rate %.2f" % (error_rate,)
+        elif len(good) >= self.MinSamples and latency > self.BaselineLatency * self.LatencyFactor:
+            new, reason = int(old * self.Decrease), "latency %.3f s/MB vs. baseline %.3f" % (latency, self.BaselineLatency)
+        elif self.LastIncreased and self.LastThroughput and \
+                    throughput < self.LastThroughput * (1.0 - self.ThroughputTolerance):
+            new, reason = int(old * self.Decrease), "throughput dropped after increase"
+        elif nwaiting > 0:
+            new, reason = old + self.Increase, "%d tasks waiting" % (nwaiting,)
+
+        new = min(self.Max, max(self.Min, new))
+        self.LastIncreased = new > old
+        self.LastThroughput = throughput
+        self.Current = new
+        if new != old:
+            self.set_workers(new)
+            self.log(f"workers: {old} -> {new}: {reason}")
+        self.Decisions.append(dict(t=time.time(), old=old, new=new, reason=reason, samples=len(samples),
+            error_rate=error_rate, throughput=throughput, latency=latency, waiting=nwaiting))
+
+    def run(self):
+        while not self.Stop:
+            self.sleep(self.Interval)
+            if not self.Stop:
+                self.adjust()
@@ -21,9 +21,10 @@ class DeclaD(PyThread, Logged):
         self.MoverManager = Manager(config, self.HistoryDB)
         scanner_type = config["scanner"].get("type")
         if scanner_type == "local":
-            self.Scanner = LocalScanner(self.MoverManager, config)
-        elif scanner_type == "xrootd":
-            self.Scanner = Scanner(self.MoverManager, config)
+            self.Scanner = LocalScanner(self.MoverManager, config, self.HistoryDB)
+        elif scanner_type in ("xrootd", "storage"):
+            # lists the location using the configured storage backend
+            self.Scanner = Scanner(self.MoverManager, config, self.HistoryDB)
         else:
             raise ValueError(f"Unknown or unspecified scanner type: {scanner_type}")
         self.Stop = False
@@ -47,6 +48,8 @@ class DeclaD(PyThread, Logged):
         self.MoverManager.stop()
         self.log("waiting for the manager to finish ...")
         self.MoverManager.join()
+        self.log("flushing the history DB ...")
+        self.HistoryDB.stop()
         self.log("ending thread")
 
     def current_transfers(self):
@@ -56,7 +59,7 @@ class DeclaD(PyThread, Logged):
         return list(self.HistoryDB.historySince(limit=limit))       # already reversed
 
     def quarantined(self):
-        files, error = self.MoverManager.quarantined()		# file descriptors
+        files, error = self.MoverManager.quarantined(self.Scanner.quarantine_locations())		# file descriptors
         if files:
             status_records = self.HistoryDB.latest_records_bulk([d.Name for d in files])
             for d in files:
@@ -72,8 +75,11 @@ class DeclaD(PyThread, Logged):
     def ls_input(self):
         return self.Scanner.ls_input()
 
-    def input_location(self):
-        return self.Scanner.Server, self.Scanner.Location
+    def scan_sources(self):
+        return self.Scanner.Sources
+
+    def concurrency_controller(self):
+        return self.MoverManager.ConcurrencyController
         
 class ThreadMonitor(PyThread, Logged):
 
@@ -123,7 +129,10 @@ if __name__ == "__main__":
     tm = ThreadMonitor(5*60)
     tm.start()
 
-    history_db = historydb.open(config.get("history_db", "history.sqlite"))
+    history_db = historydb.open(config.get("history_db", "history.sqlite"),
+            batch_size=config.get("history_batch_size"), batch_interval=config.get("history_batch_interval"),
+            purge_batch=config.get("history_purge_batch"), purge_duty_cycle=config.get("history_purge_duty_cycle"),
+            archive_dir=config.get("history_archive"))
     
     if "graphite" in config:
         from graphite_interface import GraphiteSender
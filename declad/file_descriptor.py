@@ -14,6 +14,11 @@ class FileDescriptor(object):
         while relpath and relpath[0] == "/":
             relpath = relpath[1:]
         self.RelPath = relpath              # path relative to the location root, with leading slash removed
+        self.Source = None                  # scanner source which found the file
+
+    def descriptor(self):
+        # same interface as ListingEntry
+        return self
 
     def path(self, location):
         return location + "/" + self.RelPath
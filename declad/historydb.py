@@ -1,4 +1,4 @@
-import sqlite3, time, sys
+import sqlite3, time, sys, threading, traceback, os, gzip, csv, math
 from logs import Logged
 from pythreader import Primitive, synchronized, PyThread
 
@@ -11,80 +11,434 @@ class _Record(object):
         self.Status = status
         self.Info = info
 
+class _FileState(object):
+    def __init__(self, filename, status, stage, size, tstart, next_retry, info, updated):
+        self.Name = filename
+        self.Status = status            # "queued", "in progress", "done", "failed", "quarantined"
+        self.Stage = stage              # last pipeline stage the file was in
+        self.Size = size
+        self.Started = tstart
+        self.NextRetry = next_retry     # do not start the file again before this time
+        self.Info = info
+        self.Updated = updated
+
+class _ScannerRecord(object):
+    # one scan of one scanner source, the attributes are named after the scanner_log columns
+
+    Columns = ["source", "server", "location", "t", "duration", "list_time", "pair_time", "nentries", "nfound", "nbytes",
+        "nsent", "nbytes_sent", "nremoved", "nunstable", "npending", "ncooldown", "error"]
+
+    def __init__(self, *values):
+        self.__dict__.update(zip(self.Columns, values))
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.Columns}
+
+class _HistoryWriter(PyThread, Logged):
+    #
+    # Applies the writes queued by the HistoryDB methods using one long-lived connection and commits them
+    # in groups: when batch_size writes are queued, batch_interval seconds after the first of them was queued,
+    # or when flush() is called
+    #
+
+    def __init__(self, db, batch_size, batch_interval):
+        PyThread.__init__(self, name="HistoryWriter", daemon=True)
+        Logged.__init__(self, name="HistoryWriter")
+        self.DB = db
+        self.BatchSize = batch_size
+        self.BatchInterval = batch_interval
+        self.Queue = []                 # [(sql, params), ...]
+        self.FirstQueued = None         # time when the oldest queued write was queued
+        self.NQueued = self.NCommitted = 0
+        self.NCommits = 0
+        self.Flushing = 0               # number of threads waiting in flush()
+        self.Stop = False
+
+    @synchronized
+    def write(self, sql, params=()):
+        # sql: SQL statement or function to call with the connection and the params inside the transaction
+        if not self.Queue:
+            self.FirstQueued = time.time()
+        self.Queue.append((sql, params))
+        self.NQueued += 1
+        if len(self.Queue) == 1 or len(self.Queue) >= self.BatchSize:
+            self.wakeup()
+
+    @synchronized
+    def flush(self, timeout=None):
+        # blocks until the writes queued so far are committed
+        target = self.NQueued
+        self.Flushing += 1
+        try:
+            self.wakeup()
+            self.sleep_until(lambda: self.NCommitted >= target, timeout=timeout)
+        finally:
+            self.Flushing -= 1
+
+    @synchronized
+    def stop(self):
+        # the queued writes are committed before the thread exits
+        self.Stop = True
+        self.wakeup()
+
+    @synchronized
+    def next_batch(self):
+        # waits for the next group of writes, returns None when stopped and nothing is left
+        while True:
+            if self.Queue:
+                if self.Stop or self.Flushing or len(self.Queue) >= self.BatchSize:
+                    break
+                delay = self.FirstQueued + self.BatchInterval - time.time()
+                if delay <= 0:
+                    break
+                self.sleep(delay)
+            elif self.Stop:
+                return None
+            else:
+                self.sleep()
+        batch, self.Queue = self.Queue, []
+        return batch
+
+    @synchronized
+    def committed(self, n):
+        self.NCommitted += n
+        self.NCommits += 1
+        self.wakeup()
+
+    def apply(self, conn, sql, params):
+        if callable(sql):
+            sql(conn, *params)
+        else:
+            conn.execute(sql, params)
+
+    def commit(self, conn, batch):
+        try:
+            with conn:                  # one transaction for the whole batch
+                for sql, params in batch:
+                    self.apply(conn, sql, params)
+        except:
+            # find and skip the failing write, commit the rest
+            self.error("batch commit failed, writing one by one:", "".join(traceback.format_exc()))
+            for sql, params in batch:
+                try:
+                    with conn:
+                        self.apply(conn, sql, params)
+                except:
+                    self.error("write failed:", sql if callable(sql) else sql.strip(), params, "".join(traceback.format_exc()))
+
+    def run(self):
+        conn = self.DB.connect()
+        try:
+            while True:
+                batch = self.next_batch()
+                if batch is None:
+                    break
+                self.commit(conn, batch)
+                self.committed(len(batch))
+        finally:
+            conn.close()
+
+
 class _HistoryDB(PyThread, Logged):
+    #
+    # Readers use a persistent connection per thread, writes are queued to the writer thread.
+    # The database runs in WAL mode, so the readers do not block the writer and vice versa
+    #
+
+    RollupResolutions = (60, 3600, 24*3600)         # seconds, event_rollup bins
+    DefaultBatchSize = 100
+    DefaultBatchInterval = 0.5          # seconds
+    BusyTimeout = 30                    # seconds
+    DefaultPurgeBatch = 1000            # rows deleted per transaction
+    DefaultPurgeDutyCycle = 0.2         # fraction of the time the purge may keep the writer busy
+    VacuumPages = 1000                  # pages returned to the file system per incremental vacuum step
+
+    # status codes of file_log, other statuses get new codes when first recorded
+    StatusCodes = {"done": 1, "failed": 2, "quarantined": 3}
 
-    def __init__(self, filename, keep_interval=None):
+    # purged tables: (table, rowid and columns to archive, purge condition, order, archived)
+    # the conditions may use the purge time as the parameter
+    PurgeTables = [
+        ("file_log",        "select record_id, filename, tstart, tend, status, info, size from file_records",
+                            "tend < ?",                 "tend",     True),
+        ("scanner_log",     "select rowid, * from scanner_log",
+                            "t < ?",                    "t",        True),
+        ("file_state",      "select rowid, * from file_state",
+                            "updated < ?",              "updated",  False),
+        ("event_rollup",    "select rowid, * from event_rollup",
+                            "t + resolution <= ?",      "t",        False),
+        # names and info strings no longer used by file_log
+        ("files",           "select rowid, * from files",
+                            "not exists (select 1 from file_log where file_id = files.id)",     "id",   False),
+        ("infos",           "select rowid, * from infos",
+                            "not exists (select 1 from file_log where info_id = infos.id)",     "id",   False)
+    ]
+
+    def __init__(self, filename, keep_interval=None, batch_size=None, batch_interval=None,
+                purge_batch=None, purge_duty_cycle=None, archive_dir=None):
         PyThread.__init__(self, name="HistoryDB", daemon=True)
         Logged.__init__(self, name="HistoryDB")
         self.FileName = filename
+        self.Local = threading.local()          # per-thread reader connection
         self.createTables()
         self.KeepInterval = keep_interval = keep_interval or 7*24*3600      # default: 1 week
         self.PurgeInterval = max(15, keep_interval/7)
+        self.PurgeBatch = purge_batch or self.DefaultPurgeBatch
+        self.PurgeDutyCycle = min(1.0, purge_duty_cycle or self.DefaultPurgeDutyCycle)
+        self.ArchiveDir = archive_dir               # purged file_log and scanner_log rows are saved here, if not None
+        self.Writer = _HistoryWriter(self, batch_size or self.DefaultBatchSize,
+            self.DefaultBatchInterval if batch_interval is None else batch_interval)
+        self.Writer.start()
         self.Stop = False
-        
-    class DBConnectionGuard(object):
 
-        def __init__(self, filename):
-            self.DBConnection = sqlite3.connect(filename)
+    def connect(self):
+        conn = sqlite3.connect(self.FileName, timeout=self.BusyTimeout)
+        conn.execute("pragma auto_vacuum=incremental")        # takes effect only for a new database file
+        conn.execute("pragma journal_mode=wal")
+        conn.execute("pragma synchronous=normal")       # durable in WAL mode except for the last commits on power loss
+        return conn
 
-        def __enter__(self):
-            return self.DBConnection
+    def reader(self):
+        # the calling thread's connection
+        conn = getattr(self.Local, "Connection", None)
+        if conn is None:
+            conn = self.Local.Connection = self.connect()
+        return conn
+
+    def write(self, sql, params=()):
+        self.Writer.write(sql, params)
+
+    def flush(self, timeout=None):
+        self.Writer.flush(timeout)
+
+    def stop(self):
+        self.Stop = True
+        self.wakeup()
+        self.Writer.stop()
+        self.Writer.join()
 
-        def __exit__(self, exc_type, exc_value, traceback):
-            self.DBConnection.close()
-            self.DBConnection = None
-    
     def run(self):
         self.log("started")
         while not self.Stop:
             self.sleep(self.PurgeInterval)
             if not self.Stop:
-                self.purgeOldRecords(time.time() - self.KeepInterval)
-                self.log("Old DB records purged")
+                t0 = time.time()
+                try:
+                    npurged = self.purgeOldRecords(t0 - self.KeepInterval)
+                    if npurged:
+                        self.vacuum()
+                except:
+                    self.error("purge failed:", "".join(traceback.format_exc()))
+                else:
+                    self.log("%d old DB records purged in %.1f seconds" % (npurged, time.time() - t0))
     
-    def dbconn(self):
-        return _HistoryDB.DBConnectionGuard(self.FileName)
-
     def fetch_iter(self, c):
         tup = c.fetchone()
         while tup:
             yield tup
             tup = c.fetchone()
 
-    @synchronized
     def createTables(self):
-        with self.dbconn() as conn:
+        conn = self.connect()
+        with conn:
             c = conn.cursor()
+            c.execute("begin")
+            migrated = self.migrateFileLog(c)
+            self.createFileLog(c)
             c.execute("""
-                create table if not exists file_log(
-                    filename text,
-                    tstart float,
-                    tend float,
+                create table if not exists file_state(
+                    filename text primary key,
                     status text,
-                    info text,
+                    stage text,
                     size bigint,
-                    primary key (filename, tstart))
+                    tstart float,
+                    next_retry float,
+                    info text,
+                    updated float)
                     """)
             c.execute("""
-                create index if not exists file_log_fn_event_inx on file_log(filename, status)
+                create table if not exists scanner_log(
+                    source text,
+                    server text,
+                    location text,
+                    t float,
+                    duration float,             -- whole scan, seconds
+                    list_time float,            -- waiting for the listing
+                    pair_time float,            -- parsing and pairing the data and metadata files
+                    nentries int,               -- listing entries, including directories and not matching files
+                    nfound int,                 -- data files with metadata found
+                    nbytes bigint,              -- total size of the found data files
+                    nsent int,                  -- new or changed files sent to the mover manager
+                    nbytes_sent bigint,
+                    nremoved int,
+                    nunstable int,              -- files not stable yet
+                    npending int,               -- files pending in the manager after the scan
+                    ncooldown int,              -- pending files held back by the retry cooldown
+                    error text,
+                    primary key (source, t))
+                    """)
+            self.createRollups(c)
+        if migrated:
+            # return the space of the old table to the file system, this also enables the incremental vacuum
+            t0 = time.time()
+            conn.execute("vacuum")
+            self.log("database vacuumed in %.1f seconds" % (time.time() - t0,))
+        if conn.execute("pragma auto_vacuum").fetchone()[0] != 2:
+            self.log(f"incremental vacuum is disabled for {self.FileName}. To enable, stop declad and run: "
+                f"sqlite3 {self.FileName} 'pragma auto_vacuum = incremental; vacuum'")
+        conn.close()
+
+    def createFileLog(self, c):
+        #
+        # file_log refers to the file names, statuses and info strings by integer ids,
+        # the file_records view shows the records with the names and strings
+        #
+        c.execute("""
+            create table if not exists files(
+                id integer primary key,
+                name text unique)
                 """)
-            c.execute("""
-                create index if not exists file_log_tend_inx on file_log(tend)
+        c.execute("""
+            create table if not exists statuses(
+                code integer primary key,
+                name text unique)
                 """)
+        c.executemany("insert or ignore into statuses(code, name) values(?, ?)",
+            [(code, name) for name, code in self.StatusCodes.items()])
+        c.execute("""
+            create table if not exists infos(
+                id integer primary key,
+                info text unique)
+                """)
+        c.execute("""
+            create table if not exists file_log(
+                file_id int,                -- files.id
+                tstart float,
+                tend float,
+                status int,                 -- statuses.code
+                info_id int,                -- infos.id, null if there is no info
+                size bigint,
+                primary key (file_id, tstart))
+                """)
+        c.execute("""
+            create index if not exists file_log_tend_inx on file_log(tend)
+            """)
+        c.execute("""
+            create index if not exists file_log_file_tend_inx on file_log(file_id, tend)
+            """)
+        c.execute("""
+            create index if not exists file_log_info_inx on file_log(info_id) where info_id is not null
+            """)
+        c.execute("""
+            create view if not exists file_records as
+                select l.rowid as record_id, l.file_id, f.name as filename, l.tstart, l.tend, s.name as status,
+                        coalesce(i.info, '') as info, l.size
+                    from file_log l
+                        join files f on f.id = l.file_id
+                        left join statuses s on s.code = l.status
+                        left join infos i on i.id = l.info_id
+            """)
+
+    def migrateFileLog(self, c):
+        #
+        # converts file_log with the file name, status and info text in each row to the normalized schema,
+        # returns True if converted
+        #
+        columns = [row[1] for row in c.execute("pragma table_info(file_log)").fetchall()]
+        if "filename" not in columns:
+            return False
+        t0 = time.time()
+        self.log("converting file_log to the normalized schema ...")
+        for trigger in ("file_log_rollup_insert", "file_log_rollup_update"):
+            c.execute(f"drop trigger if exists {trigger}")
+        for index in ("file_log_fn_event_inx", "file_log_tend_inx", "file_log_fn_tend_inx"):
+            c.execute(f"drop index if exists {index}")
+        c.execute("drop table if exists event_rollup")             # re-created with status codes
+        c.execute("alter table file_log rename to file_log_text")
+        self.createFileLog(c)
+        c.execute("insert or ignore into files(name) select distinct filename from file_log_text")
+        c.execute("insert or ignore into statuses(name) select distinct status from file_log_text where status is not null")
+        c.execute("insert or ignore into infos(info) select distinct info from file_log_text where info is not null and info != ''")
+        c.execute("""
+            insert or ignore into file_log(file_id, tstart, tend, status, info_id, size)
+                select f.id, l.tstart, l.tend, s.code, i.id, l.size
+                    from file_log_text l
+                        join files f on f.name = l.filename
+                        left join statuses s on s.name = l.status
+                        left join infos i on i.info = l.info
+            """)
+        n = c.execute("select count(*) from file_log").fetchone()[0]
+        c.execute("drop table file_log_text")
+        self.log("%d file_log records converted in %.1f seconds" % (n, time.time() - t0))
+        return True
+
+    def createRollups(self, c):
+        #
+        # event_rollup: number of file_log records and bytes per status and time bin, for each of the RollupResolutions,
+        # kept up to date by the triggers on file_log
+        #
+        exists = c.execute("select name from sqlite_master where type = 'table' and name = 'event_rollup'").fetchone()
+        c.execute("""
+            create table if not exists event_rollup(
+                resolution int,
+                t int,                      -- bin start
+                status int,                 -- statuses.code
+                count int,
+                bytes bigint,
+                primary key (resolution, t, status))
+                """)
+
+        def add(row, sign):
+            # adds the old or new file_log row to the bins, records without tend are not counted
+            return "".join(f"""
+                insert into event_rollup(resolution, t, status, count, bytes)
+                    select {r}, cast({row}.tend / {r} as int) * {r}, {row}.status, {sign}1, {sign}coalesce({row}.size, 0)
+                        where {row}.tend is not null
+                    on conflict(resolution, t, status) do update set count = count + excluded.count, bytes = bytes + excluded.bytes;
+                """ for r in self.RollupResolutions)
+
+        c.execute(f"""
+            create trigger if not exists file_log_rollup_insert after insert on file_log
+            begin
+                {add("new", "")}
+            end
+            """)
+        c.execute(f"""
+            create trigger if not exists file_log_rollup_update after update of tend, status, size on file_log
+            begin
+                {add("old", "-")}
+                {add("new", "")}
+            end
+            """)
+
+        if not exists:
+            # existing history
+            for r in self.RollupResolutions:
+                c.execute(f"""
+                    insert into event_rollup(resolution, t, status, count, bytes)
+                        select {r}, cast(tend / {r} as int) * {r} as tt, status, count(*), sum(coalesce(size, 0))
+                            from file_log
+                            where tend is not null
+                            group by tt, status
+                    """)
 
-    @synchronized
     def add_record(self, filename, size, tstart, tend, status, info):
         #self.debug("add_record: file:", filename, "size:", size, "start:", tstart, "end:", tend, "status", status, "info:", info)
-        with self.dbconn() as conn:
-            c = conn.cursor()
-            c.execute("""
-                insert into file_log(filename, tstart, tend, status, info, size) values(?,?,?,?,?,?)
-                    on conflict(filename, tstart) do update set tend = ?, status = ?
-                """, (filename, tstart, tend, status, info, size,
-                        tend, status
-                )
-            )  
-            conn.commit()    
+        self.write(self.insert_record, (filename, size, tstart, tend, status, info or None))
+
+    def insert_record(self, conn, filename, size, tstart, tend, status, info):
+        # called by the writer
+        conn.execute("insert or ignore into files(name) values(?)", (filename,))
+        conn.execute("insert or ignore into statuses(name) values(?)", (status,))
+        if info is not None:
+            conn.execute("insert or ignore into infos(info) values(?)", (info,))
+        conn.execute("""
+            insert into file_log(file_id, tstart, tend, status, info_id, size)
+                values((select id from files where name = ?), ?, ?, (select code from statuses where name = ?),
+                    (select id from infos where info = ?), ?)
+                on conflict(file_id, tstart) do update set tend = excluded.tend, status = excluded.status
+            """, (filename, tstart, tend, status, info, size)
+        )
            
     def file_done(self, filename, size, tstart, tend=None):
         tend = tend or time.time()
@@ -99,103 +453,213 @@ class _HistoryDB(PyThread, Logged):
         tend = tend or time.time()
         self.add_record(filename, None, tstart, tend, "quarantined", reason)
         
-    @synchronized
+    def save_state(self, filename, status, stage=None, size=None, tstart=None, next_retry=None, info=None):
+        # work state of the file, used to resume the retry cooldowns after restart
+        self.write("""
+            insert into file_state(filename, status, stage, size, tstart, next_retry, info, updated) values(?,?,?,?,?,?,?,?)
+                on conflict(filename) do update set status = excluded.status, stage = excluded.stage, 
+                    size = coalesce(excluded.size, size), tstart = coalesce(excluded.tstart, tstart),
+                    next_retry = coalesce(excluded.next_retry, next_retry), info = excluded.info, updated = excluded.updated
+            """, (filename, status, stage, size, tstart, next_retry, info, time.time())
+        )
+
+    def load_state(self, since=0):
+        conn = self.reader()
+        c = conn.cursor()
+        c.execute("""select filename, status, stage, size, tstart, next_retry, info, updated
+                from file_state
+                where updated >= ?""", (since,))
+        return [_FileState(*tup) for tup in c.fetchall()]
+
+    def add_scanner_record(self, source, server, location, t, duration, error=None, **metrics):
+        # metrics: other scanner_log columns, missing ones are recorded as null
+        values = dict(metrics, source=source, server=server, location=location, t=t, duration=duration, error=error)
+        columns = _ScannerRecord.Columns
+        self.write(f"""
+            insert or replace into scanner_log({", ".join(columns)}) values({",".join("?" * len(columns))})
+            """, tuple(values.get(name) for name in columns)
+        )
+
+    def scannerHistorySince(self, t=0, source=None):
+        # returns scan records sorted by source and time
+        source_where = "" if source is None else " and source = ?"
+        conn = self.reader()
+        c = conn.cursor()
+        c.execute(f"""select {", ".join(_ScannerRecord.Columns)}
+                from scanner_log
+                where t >= ? {source_where}
+                order by source, t""", (t,) if source is None else (t, source)
+        )
+        return [_ScannerRecord(*tup) for tup in c.fetchall()]
+
     def latest_records_bulk(self, filenames, status=None, since=None):
-        status_where = "" if not status else f" and status = '{status}' "
-        since_where = "" if since is None else f" and tend >= {since}"
-        fnlist = ",".join([f"'{fn}'" for fn in filenames])
-        out = {}
-        with self.dbconn() as conn:
-            c = conn.cursor()
-            sql = f"""select filename, tstart, tend, status, info, size
-                    from file_log
-                    where filename in ({fnlist})
-                        {status_where}
-                        {since_where}
-                    order by tend
-                """
-            c.execute(sql)
-
-            for filename, tstart, tend, status, info, size in c.fetchall():
-                out[filename] = (tstart, tend, status, info, size)
-        
-        return out
-        
-    @synchronized
+        # returns {filename: (tstart, tend, status, info, size)} with the latest record for each of the files,
+        # optionally only among the records with the status and/or with tend >= since
+        # the names are loaded into a temporary table of the thread's connection, the transaction is rolled back
+        # at the end, which empties the table
+        where = ""
+        params = []
+        if status:
+            where += " and status = ?"
+            params.append(status)
+        if since is not None:
+            where += " and tend >= ?"
+            params.append(since)
+        conn = self.reader()
+        c = conn.cursor()
+        c.execute("create temp table if not exists bulk_names(filename text primary key)")
+        try:
+            c.executemany("insert or ignore into temp.bulk_names(filename) values(?)", ((fn,) for fn in filenames))
+            # bare columns of a max() aggregate come from the row with the max value
+            c.execute(f"""select filename, tstart, max(tend), status, info, size
+                    from file_records
+                    where filename in (select filename from temp.bulk_names)
+                        {where}
+                    group by file_id
+                """, params)
+            return {filename: (tstart, tend, status, info, size) for filename, tstart, tend, status, info, size in c.fetchall()}
+        finally:
+            conn.rollback()
+
     def historySince(self, t=0, limit=None):
         #
         # always returns records sorted by tend in reversed order
         #
-        with self.dbconn() as conn:
-            c = conn.cursor()
-            if limit:   limit = f"limit {limit}"
-            c.execute(f"""select filename, tstart, tend, status, info, size 
-                    from file_log 
-                    where tend >= ?
-                    order by tend desc
-                    {limit}
-                    """, (t,)
-            )
-            return [_Record(*tup) for tup in c.fetchall()]
+        conn = self.reader()
+        c = conn.cursor()
+        if limit:   limit = f"limit {limit}"
+        c.execute(f"""select filename, tstart, tend, status, info, size 
+                from file_records 
+                where tend >= ?
+                order by tend desc
+                {limit}
+                """, (t,)
+        )
+        return [_Record(*tup) for tup in c.fetchall()]
 
-    @synchronized
     def getRecords(self, status, since_t=None):
         since_t = since_t or 0
-        with self.dbconn() as conn:
-            c = conn.cursor()
-            c.execute("""select filename, status, tend, size, tend-tstart
-                    from file_log
-                    where status = ? and tend > ?
-                    order by tend""",
-                    (status, since_t)
-            )
-            return c.fetchall()
+        conn = self.reader()
+        c = conn.cursor()
+        c.execute("""select filename, status, tend, size, tend-tstart
+                from file_records
+                where status = ? and tend > ?
+                order by tend""",
+                (status, since_t)
+        )
+        return c.fetchall()
+
+    def throttle(self, busy):
+        # sleeps long enough to keep the purge within the duty cycle after being busy for this many seconds
+        if self.PurgeDutyCycle < 1.0 and not self.Stop:
+            self.sleep(busy * (1.0 - self.PurgeDutyCycle) / self.PurgeDutyCycle)
+
+    def open_archive(self, table, columns):
+        # returns (file, csv writer) for a new compressed archive segment
+        os.makedirs(self.ArchiveDir, exist_ok=True)
+        path = os.path.join(self.ArchiveDir, "%s.%s.csv.gz" % (table, time.strftime("%Y%m%d_%H%M%S", time.gmtime())))
+        f = gzip.open(path, "wt", newline="")
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        return f, writer
 
-    @synchronized
     def purgeOldRecords(self, before):
-        with self.dbconn() as conn:
-            c = conn.cursor()
-            c.execute("delete from file_log where tend < ?", (before,))
-            conn.commit()
-            
-    @synchronized
-    def eventCounts(self, bin, since_t = 0):
-        with self.dbconn() as conn:
-            c = conn.cursor()
-            c.execute("""select status, tend
-                    from file_log
-                    where tend >= ?""", (since_t,))
-            counts = {}     # (status, bin) -> count
-            for status, tend in c.fetchall():
-                tend = int(tend/bin)*bin
-                key = (status, tend)
-                counts[key] = counts.get(key, 0) + 1
-            return [(key[0], key[1], count) for key, count in sorted(counts.items())]
+        #
+        # Deletes the records older than before in batches of PurgeBatch rows, one transaction per batch, sleeping
+        # between the batches to stay within the duty cycle. If ArchiveDir is set, the file_log and scanner_log rows
+        # are written to an archive segment before they are deleted.
+        # Returns the number of deleted rows
+        #
+        total = 0
+        for table, select, condition, order, archived in self.PurgeTables:
+            condition_params = (before,) * condition.count("?")
+            archive = None
+            try:
+                while not self.Stop:
+                    t0 = time.time()
+                    c = self.reader().execute(f"{select} where {condition} order by {order} limit ?",
+                        condition_params + (self.PurgeBatch,))
+                    columns = [d[0] for d in c.description[1:]]
+                    rows = c.fetchall()
+                    if not rows:
+                        break
+                    if archived and self.ArchiveDir:
+                        if archive is None:
+                            archive = self.open_archive(table, columns)
+                        archive_file, archive_writer = archive
+                        archive_writer.writerows(row[1:] for row in rows)
+                        archive_file.flush()
+                    rowids = [row[0] for row in rows]
+                    # the condition is checked again, the rows may have been used again since they were selected
+                    self.write(f"delete from {table} where rowid in ({','.join('?' * len(rowids))}) and {condition}",
+                        rowids + list(condition_params))
+                    self.flush()
+                    total += len(rows)
+                    self.throttle(time.time() - t0)
+            finally:
+                if archive is not None:
+                    archive[0].close()
+        return total
 
-    @synchronized
-    def eventCounts____(self, bin, since_t = 0):
-        with self.dbconn() as conn:
-            c = conn.cursor()
-            c.execute("""select status, round(tend/?)*? as tt, count(*)
-                    from file_log
-                    where tend >= ?
-                    group by status, tt
-                    order by status, tt""", (bin, bin, since_t))
-            return c.fetchall()
+    def vacuum(self):
+        # returns the free pages to the file system in small steps, if the database uses incremental auto-vacuum
+        conn = self.reader()
+        if conn.execute("pragma auto_vacuum").fetchone()[0] != 2:
+            return
+        while not self.Stop and conn.execute("pragma freelist_count").fetchone()[0] > 0:
+            t0 = time.time()
+            # the pragma frees one page per step of the statement
+            self.write(lambda c: c.execute(f"pragma incremental_vacuum({self.VacuumPages})").fetchall())
+            self.flush()
+            self.throttle(time.time() - t0)
+
+    def eventCounts(self, bin, since_t = 0, with_bytes = False):
+        # returns [(status, t, count), ...] or, with_bytes, [(status, t, count, bytes), ...] sorted by status and t
+        # uses the coarsest rollup the bin is a multiple of. since_t is rounded up to the rollup bin boundary,
+        # so that no events before since_t are counted
+        resolution = max([r for r in self.RollupResolutions if bin % r == 0], default=None)
+        if resolution is None:
+            return self.eventCountsFromLog(bin, since_t, with_bytes)
+        conn = self.reader()
+        c = conn.cursor()
+        c.execute("""select s.name, cast(t / ? as int) * ? as tt, sum(count), sum(bytes)
+                from event_rollup r
+                    join statuses s on s.code = r.status
+                where resolution = ? and t >= ?
+                group by s.name, tt
+                having sum(count) > 0
+                order by s.name, tt""", (bin, bin, resolution, math.ceil(since_t / resolution) * resolution))
+        return [row if with_bytes else row[:3] for row in c.fetchall()]
+
+    def eventCountsFromLog(self, bin, since_t = 0, with_bytes = False):
+        # for the bins not aligned with the rollups
+        conn = self.reader()
+        c = conn.cursor()
+        c.execute("""select status, tend, size
+                from file_records
+                where tend >= ?""", (since_t,))
+        counts = {}     # (status, bin) -> [count, bytes]
+        for status, tend, size in c.fetchall():
+            tend = int(tend/bin)*bin
+            key = (status, tend)
+            total = counts.setdefault(key, [0, 0])
+            total[0] += 1
+            total[1] += size or 0
+        return [(key[0], key[1]) + (tuple(total) if with_bytes else (total[0],)) for key, total in sorted(counts.items())]
 
-    @synchronized
     def historyForFile(self, filename):
         # returns [(t, event, info),...]
-        with self.dbconn() as conn:
-            c = conn.cursor()
-            c.execute("""
-                select tstart, tend, status, info
-                    from file_log 
-                    where filename = ?
-                    order by tend
-                    """, (filename,))
-            return c.fetchall()
+        conn = self.reader()
+        c = conn.cursor()
+        c.execute("""
+            select tstart, tend, status, info
+                from file_records 
+                where filename = ?
+                order by tend
+                """, (filename,))
+        return c.fetchall()
             
-def open(path):
-    return _HistoryDB(path)
+def open(path, batch_size=None, batch_interval=None, purge_batch=None, purge_duty_cycle=None, archive_dir=None):
+    return _HistoryDB(path, batch_size=batch_size, batch_interval=batch_interval,
+        purge_batch=purge_batch, purge_duty_cycle=purge_duty_cycle, archive_dir=archive_dir)
                 
@@ -0,0 +1,76 @@
+import getopt, sys, time, os, random, sqlite3
+import historydb
+
+Usage = """
+python historydb_benchmark.py [-n <number of records>] [-f <database file>] <number of names> ...
+    -n <number of records>  - default 1000000, 3 records per file
+    -f <database file>      - default /tmp/historydb_benchmark.sqlite, re-created
+
+Measures latest_records_bulk() for lists of file names, half of them found in the history,
+and compares it to the former single "in ('name', ...)" query
+"""
+
+def populate(path, n):
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    db = historydb.open(path)
+    conn = db.connect()
+    t0 = time.time() - 7*24*3600
+    statuses = ["failed", "failed", "done"]
+    with conn:
+        conn.executemany("insert into files(name) values(?)", ((f"np04_raw_run{i:08d}_dl1.hdf5",) for i in range((n+2)//3)))
+        conn.executemany("""insert into file_log(file_id, tstart, tend, status, size)
+                values((select id from files where name = ?), ?, ?, (select code from statuses where name = ?), ?)""",
+            ((f"np04_raw_run{i//3:08d}_dl1.hdf5", t0 + i, t0 + i + 10, statuses[i%3], 1000000) for i in range(n)))
+    conn.close()
+    return db
+
+def latest_records_in_string(db, filenames):
+    # former implementation: names interpolated into the SQL, all the records returned ordered by tend
+    fnlist = ",".join([f"'{fn}'" for fn in filenames])
+    out = {}
+    c = db.reader().cursor()
+    c.execute(f"""select filename, tstart, tend, status, info, size
+            from file_records
+            where filename in ({fnlist})
+            order by tend
+        """)
+    for filename, tstart, tend, status, info, size in c.fetchall():
+        out[filename] = (tstart, tend, status, info, size)
+    return out
+
+def timed(title, f):
+    t0 = time.time()
+    try:
+        out = f()
+    except Exception as e:
+        print("%-40s failed: %s" % (title, e))
+        return None
+    print("%-40s %8.3f sec   %d found" % (title, time.time() - t0, len(out)))
+    return out
+
+opts, args = getopt.getopt(sys.argv[1:], "n:f:h?")
+opts = dict(opts)
+if "-h" in opts or "-?" in opts:
+    print(Usage)
+    sys.exit(2)
+
+n = int(opts.get("-n", 1000000))
+path = opts.get("-f", "/tmp/historydb_benchmark.sqlite")
+sizes = [int(a) for a in args] or [1000, 10000, 100000]
+
+t0 = time.time()
+db = populate(path, n)
+print("%d records created in %.1f sec" % (n, time.time() - t0))
+nfiles = n // 3
+
+for size in sizes:
+    names = [f"np04_raw_run{random.randrange(nfiles):08d}_dl1.hdf5" for _ in range(size//2)] \
+        + [f"missing_{i:08d}.hdf5" for i in range(size - size//2)]
+    print(f"{size} names:")
+    new = timed("  latest_records_bulk:", lambda: db.latest_records_bulk(names))
+    old = timed("  in string:", lambda: latest_records_in_string(db, names))
+    if new is not None and old is not None:
+        print("  same results:", new == old)
+timed("  names with quotes:", lambda: db.latest_records_bulk(["it's.hdf5", 'say "hi".hdf5']))
@@ -0,0 +1,71 @@
+import ctypes, ctypes.util, os, struct, select
+
+class INotify(object):
+    """
+    Minimal Linux inotify interface using ctypes. Raises OSError if inotify is not available.
+    """
+
+    IN_CLOSE_WRITE  = 0x00000008
+    IN_MOVED_FROM   = 0x00000040
+    IN_MOVED_TO     = 0x00000080
+    IN_CREATE       = 0x00000100
+    IN_DELETE       = 0x00000200
+    IN_DELETE_SELF  = 0x00000400
+    IN_MOVE_SELF    = 0x00000800
+    IN_Q_OVERFLOW   = 0x00004000
+    IN_IGNORED      = 0x00008000
+    IN_ONLYDIR      = 0x01000000
+    IN_ISDIR        = 0x40000000
+
+    IN_NONBLOCK     = os.O_NONBLOCK
+    IN_CLOEXEC      = os.O_CLOEXEC
+
+    EventHeader = struct.Struct("iIII")         # wd, mask, cookie, len
+    BufferSize = 64*1024
+
+    def __init__(self):
+        try:
+            self.LibC = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            self.LibC.inotify_init1
+        except (OSError, AttributeError) as e:
+            raise OSError(f"inotify is not available: {e}")
+        self.FD = self.LibC.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.FD < 0:
+            self.raise_errno("inotify_init1")
+
+    def raise_errno(self, what):
+        err = ctypes.get_errno()
+        raise OSError(err, f"{what}: {os.strerror(err)}")
+
+    def add_watch(self, path, mask):
+        wd = self.LibC.inotify_add_watch(self.FD, os.fsencode(path), ctypes.c_uint32(mask))
+        if wd < 0:
+            self.raise_errno(f"inotify_add_watch({path})")
+        return wd
+
+    def remove_watch(self, wd):
+        self.LibC.inotify_rm_watch(self.FD, wd)
+
+    def read(self, timeout=None):
+        # returns [(wd, mask, cookie, name), ...], empty list if no events arrived before the timeout
+        readable, _, _ = select.select([self.FD], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.FD, self.BufferSize)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset + self.EventHeader.size <= len(data):
+            wd, mask, cookie, length = self.EventHeader.unpack_from(data, offset)
+            offset += self.EventHeader.size
+            name = os.fsdecode(data[offset:offset+length].rstrip(b"\0"))
+            offset += length
+            events.append((wd, mask, cookie, name))
+        return events
+
+    def close(self):
+        if self.FD is not None and self.FD >= 0:
+            os.close(self.FD)
+        self.FD = None
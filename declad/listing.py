@@ -0,0 +1,107 @@
+from array import array
+from file_descriptor import FileDescriptor
+
+class ListingEntry(object):
+    #
+    # Reference to one file of a FileListing. The FileDescriptor is created only when the file is queued
+    #
+
+    __slots__ = ("Listing", "Index")
+
+    def __init__(self, listing, index):
+        self.Listing = listing
+        self.Index = index
+
+    @property
+    def Name(self):
+        return self.Listing.name(self.Index)
+
+    @property
+    def Size(self):
+        return self.Listing.size(self.Index)
+
+    def descriptor(self):
+        return self.Listing.descriptor(self.Index)
+
+
+class FileListing(object):
+    """
+    Compact listing of the files found under one location. The server and location are stored once,
+    the relative paths are stored in one UTF-8 buffer and the data and metadata file sizes in arrays.
+    FileDescriptor objects are created on demand by descriptor().
+    """
+
+    def __init__(self, server, location, source=None):
+        self.Server = server
+        self.Location = location
+        self.Source = source                # scanner source, set as the Source of the created FileDescriptors
+        self.Paths = bytearray()            # relative paths, concatenated
+        self.Offsets = array("Q", [0])      # path i is Paths[Offsets[i]:Offsets[i+1]]
+        self.Sizes = array("q")
+        self.MetaSizes = array("q")         # -1 if unknown
+
+    def __len__(self):
+        return len(self.Sizes)
+
+    def append(self, relpath, size, meta_size=-1):
+        self.Paths += relpath.encode("utf-8")
+        self.Offsets.append(len(self.Paths))
+        self.Sizes.append(size)
+        self.MetaSizes.append(meta_size)
+        return len(self.Sizes) - 1
+
+    def add(self, path, size, meta_size=-1):
+        # path is the absolute path under the location
+        relpath = path[len(self.Location):].lstrip("/") if path.startswith(self.Location) else path
+        return self.append(relpath, size, meta_size)
+
+    def relpath(self, i):
+        return self.Paths[self.Offsets[i]:self.Offsets[i+1]].decode("utf-8")
+
+    def name(self, i):
+        return self.relpath(i).rsplit("/", 1)[-1]
+
+    def size(self, i):
+        return self.Sizes[i]
+
+    def meta_size(self, i):
+        size = self.MetaSizes[i]
+        return None if size < 0 else size
+
+    def path(self, i):
+        return self.Location + "/" + self.relpath(i)
+
+    def descriptor(self, i):
+        desc = FileDescriptor(self.Server, self.Location, self.path(i), self.Sizes[i])
+        desc.Source = self.Source
+        return desc
+
+    def entry(self, i):
+        return ListingEntry(self, i)
+
+    def entries(self):
+        return (ListingEntry(self, i) for i in range(len(self)))
+
+    def names(self):
+        return (self.name(i) for i in range(len(self)))
+
+    def names_bytes(self):
+        # list of the UTF-8 encoded names, without decoding them
+        paths, offsets = self.Paths, self.Offsets
+        names = []
+        for i in range(len(self)):
+            start, end = offsets[i], offsets[i+1]
+            names.append(bytes(paths[max(start, paths.rfind(b"/", start, end) + 1):end]))
+        return names
+
+    def subset(self, indexes):
+        # returns new FileListing with the selected files
+        out = FileListing(self.Server, self.Location, self.Source)
+        for i in indexes:
+            out.append(self.relpath(i), self.Sizes[i], self.MetaSizes[i])
+        return out
+
+    def nbytes(self):
+        # approximate memory used by the columns
+        return len(self.Paths) + self.Offsets.itemsize * len(self.Offsets) \
+            + self.Sizes.itemsize * len(self.Sizes) + self.MetaSizes.itemsize * len(self.MetaSizes)
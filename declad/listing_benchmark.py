@@ -0,0 +1,136 @@
+import getopt, sys, time, tracemalloc, gc
+from file_descriptor import FileDescriptor
+from listing import FileListing
+
+Usage = """
+python listing_benchmark.py [-n <number of files>] [-q <number of files to queue>]
+    -n <number of files>    - default 1000000
+    -q <files to queue>     - number of FileDescriptors created from the listing, default 1000
+
+Compares the memory and time needed to hold a synthetic scan listing as FileDescriptor objects and as FileListing,
+then runs 3 scans of the listing through ScanSource.scan, with the former and the current snapshot, and shows the memory
+held by the snapshot after them. Build times include the tracemalloc overhead
+"""
+
+Server = "root://dropbox.example.org:1094"
+Location = "/pnfs/example.org/data/experiment/scratch/dropbox"
+
+def paths(n):
+    for i in range(n):
+        yield f"run{i//1000:06d}/np04_raw_run{i//1000:06d}_{i%1000:04d}_dl1.hdf5", 1000000000 + i
+
+def measure(title, build):
+    gc.collect()
+    tracemalloc.start()
+    t0 = time.time()
+    out = build()
+    elapsed = time.time() - t0
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print("%-30s build: %6.2f sec   memory: %8.1f MB   peak: %8.1f MB" % (title, elapsed, current/1e6, peak/1e6))
+    return out
+
+def build_descriptors(n):
+    return [FileDescriptor(Server, Location, Location + "/" + relpath, size) for relpath, size in paths(n)]
+
+def build_listing(n):
+    listing = FileListing(Server, Location)
+    for relpath, size in paths(n):
+        listing.append(relpath, size, 1000)
+    return listing
+
+def timed(title, f):
+    t0 = time.time()
+    f()
+    print("%-30s %6.2f sec" % (title, time.time() - t0))
+
+opts, args = getopt.getopt(sys.argv[1:], "n:q:h?")
+opts = dict(opts)
+if "-h" in opts or "-?" in opts:
+    print(Usage)
+    sys.exit(2)
+
+n = int(opts.get("-n", 1000000))
+nqueue = int(opts.get("-q", 1000))
+print(f"{n} files")
+
+descs = measure("FileDescriptor list", lambda: build_descriptors(n))
+timed("  iterate names and sizes:", lambda: sum(len(d.Name) + d.Size for d in descs))
+del descs
+
+listing = measure("FileListing", lambda: build_listing(n))
+timed("  iterate names and sizes:", lambda: sum(len(listing.name(i)) + listing.size(i) for i in range(len(listing))))
+timed(f"  create {nqueue} descriptors:", lambda: [listing.descriptor(i) for i in range(min(nqueue, len(listing)))])
+print("  column bytes:                %.1f MB" % (listing.nbytes()/1e6,))
+
+#
+# End-to-end scan: pairing the listing with the metadata files and updating the snapshot
+#
+
+from scanner import ScanSource
+
+class FormerSnapshot(object):
+    # former ScanSnapshot state, dicts of tuples
+    def __init__(self, stable_scans):
+        self.StableScans = stable_scans
+        self.Seen = {}
+        self.Reported = {}
+
+    def update(self, listing):
+        seen = {}
+        selected = []
+        for i in range(len(listing)):
+            name = listing.name(i)
+            sizes = (listing.size(i), listing.meta_size(i))
+            last_sizes, count = self.Seen.get(name, (None, 0))
+            count = count + 1 if sizes == last_sizes else 1
+            seen[name] = (sizes, count)
+            if count >= self.StableScans and self.Reported.get(name) != sizes:
+                selected.append(i)
+                self.Reported[name] = sizes
+        removed = [name for name in self.Reported if name not in seen]
+        for name in removed:
+            del self.Reported[name]
+        self.Seen = seen
+        return listing.subset(selected), removed
+
+    def unstable(self):
+        return sum(1 for name in self.Seen if name not in self.Reported)
+
+class Receiver(object):
+    def add_files(self, listing):       pass
+    def remove_files(self, names):      pass
+    def pending_counts(self):           return 0, 0
+
+def scan_listing(n):
+    for relpath, size in paths(n):
+        path = Location + "/" + relpath
+        yield FileDescriptor(Server, Location, path, size)
+        yield FileDescriptor(Server, Location, path + ".json", 1000)
+
+def scans(source, n, nscans=3):
+    # the second scan sends all the files, the others none
+    for _ in range(nscans):
+        source.scan(scan_listing(n), Receiver())
+    return source
+
+def new_source(snapshot):
+    source = ScanSource(config, config["scanner"])
+    if snapshot is not None:
+        source.Snapshot = snapshot
+    return source
+
+import logs
+logs.init("/dev/null", error_out="-")
+config = {"scanner": {"location": Location, "filename_patterns": ["*.hdf5"]}}
+for title, snapshot_class in (("ScanSource.scan, former snapshot", FormerSnapshot), ("ScanSource.scan", None)):
+    source = measure(title + " x3", lambda: scans(new_source(snapshot_class and snapshot_class(2)), n))
+    del source
+    source = new_source(snapshot_class and snapshot_class(2))
+    for i in range(3):
+        scans(source, n, 1)
+        metrics = source.LastMetrics
+        print("  scan %d without tracemalloc:  %6.2f sec   listing: %.2f   pairing: %.2f   snapshot: %.2f" % (i+1,
+            source.duration(), metrics["list_time"], metrics["pair_time"],
+            source.duration() - metrics["list_time"] - metrics["pair_time"]))
+    del source
@@ -1,13 +1,18 @@
 from pythreader import PyThread
-from tools import runCommand
-import time, fnmatch, traceback, re, stat, os.path
+from tools import runCommand, iterCommandLines, CommandError
+import time, re, stat, os.path
 from logs import Logged
+from scanner import ScanSource
 from file_descriptor import FileDescriptor
+from inotify import INotify
 
 class LocalScanner(PyThread, Logged):
 
-    DefaultMetaSuffix = ".json"
     DefaultInterval = 300
+    DefaultMaxParseErrors = 100
+    WatchMask = INotify.IN_CLOSE_WRITE | INotify.IN_MOVED_TO | INotify.IN_MOVED_FROM | INotify.IN_DELETE | INotify.IN_CREATE \
+        | INotify.IN_ONLYDIR
+    MaxWatchWait = 5.0          # seconds, how often to check for the stop request while waiting for events
 
     # Linux ls -l pattern
     #
@@ -15,7 +20,7 @@ class LocalScanner(PyThread, Logged):
     # -rw-r--r-- 1 ivm3 ivm3 1228 Mar 22 16:52 /home/ivm3/token
     DefaultParseRE = r"(?P<type>[a-z-])\S+\s+\d+\s+\S+\s+\S+\s+(?P<size>\d+)\s+\S+\s+\d+\s+\S+\s+(?P<path>\S+)$"
 
-    def __init__(self, receiver, config):
+    def __init__(self, receiver, config, history_db=None):
         PyThread.__init__(self, daemon=True, name="Scanner")
         Logged.__init__(self, f"Scanner")
         self.Receiver = receiver
@@ -25,98 +30,196 @@ class LocalScanner(PyThread, Logged):
         self.ReplaceLocation = scan_config.get("replace_location")
         self.lsCommandTemplate = scan_config["ls_command_template"]            
         self.ParseRE = re.compile(scan_config.get("parse_re", self.DefaultParseRE))
-        patterns = scan_config.get("filename_patterns") or scan_config.get("filename_pattern")
-        if not patterns:
-            raise ValueError("Filename patterns (filename_patterns) not found in the config file")
-        self.FilenamePatterns = patterns if isinstance(patterns, list) else [patterns]
-        self.MetaSuffix = config.get("meta_suffix", self.DefaultMetaSuffix)
-        self.MetadataPatterns = [pattern + self.MetaSuffix for pattern in self.FilenamePatterns]
+        self.MaxParseErrors = scan_config.get("max_parse_errors", self.DefaultMaxParseErrors)
+        self.Source = ScanSource(config, scan_config, history_db=history_db)
+        self.Sources = [self.Source]
+        self.Watch = scan_config.get("watch", False)                 # send files on inotify events, rescan every interval
+        self.WatchRecursive = scan_config.get("watch_recursive", False)
+        self.INotify = None
+        self.WatchedDirs = {}           # wd -> path
+        self.RescanNeeded = False
         self.Stop = False
         self.Server = None
+
+    def stop(self):
+        self.Stop = True
+        self.wakeup()
+
+    def file_descriptor(self, location, path, size):
+        if self.ReplaceLocation:
+            path = self.ReplaceLocation + path[len(location):]
+        return FileDescriptor(self.Server, location, path, size)
         
-    def do_ls(self, location, timeout=None):
+    def iter_ls(self, location, timeout=None, root=None):
+        #
+        # Reads the ls output line by line and yields FileDescriptor for each file and path for each directory.
+        # root: the scanned location the file paths are relative to, default: location
+        # Raises CommandError if the ls command fails and ValueError if too many lines can not be parsed
+        #
+        root = root or location
         lscommand = self.lsCommandTemplate.replace("$location", location)
         #print("lscommand:", lscommand)
+        nerrors = 0
+        for l in iterCommandLines(lscommand, timeout, self.debug):
+            l = l.strip()
+            if l:
+                m = self.ParseRE.match(l)
+                if m:
+                    t = m["type"]
+                    path = m["path"]
+                    path = path if path.startswith(location) else location + "/" + path
+                    if t in "f-":
+                        size = int(m["size"])
+                        if size == 0:
+                            self.debug("Zero file size in:\n   ", l)
+                        yield self.file_descriptor(root, path, size)
+                    elif t == "d": 
+                        yield self.ReplaceLocation + path[len(root):] if self.ReplaceLocation else path
+                    else:
+                        self.log(f"Unknown directory entry type '{t}' in: {l} -- ignored")
+                else:
+                    nerrors += 1            # e.g. "total ..." line
+                    if nerrors > self.MaxParseErrors:
+                        raise ValueError(f"More than {self.MaxParseErrors} lines can not be parsed in the output of {lscommand}. Last: {l}")
+
+    def iter_ls_tree(self, location, timeout=None):
+        # same as iter_ls, but lists the subdirectories too
+        dirs = [location]
+        while dirs:
+            for item in self.iter_ls(dirs.pop(), timeout, root=location):
+                yield item
+                if not isinstance(item, FileDescriptor):
+                    if self.ReplaceLocation:
+                        item = location + item[len(self.ReplaceLocation):]
+                    dirs.append(item)
+
+    def do_ls(self, location, timeout=None):
         files = []
         dirs = []
-        error = ""
-        status, out = runCommand(lscommand, timeout, self.debug)
-        if status:
-            error = out
-            self.log("ls (%s) error: %s" % (lscommand, error,))
-        else:
-            lines = [x.strip() for x in out.split("\n")]
-            for l in lines:
-                if l:
-                    m = self.ParseRE.match(l)
-                    if m:
-                        t = m["type"]
-                        path = m["path"]
-                        orig_path = path = path if path.startswith(location) else location + "/" + path
-                        if self.ReplaceLocation:
-                            path = self.ReplaceLocation + path[len(location):]
-                        if t in "f-":
-                            size = int(m["size"])
-                            if size == 0:
-                                self.debug("Zero file size in:\n   ", l)
-                            files.append(FileDescriptor(self.Server, location, path, size))
-                        elif t == "d": 
-                            dirs.append(path)
-                        else:
-                            self.log(f"Unknown directory entry type '{t}' in: {l} -- ignored")
-        return status, error, files, dirs
-
-    def ls_files(self):
+        try:
+            for item in self.iter_ls(location, timeout):
+                if isinstance(item, FileDescriptor):
+                    files.append(item)
+                else:
+                    dirs.append(item)
+        except (CommandError, ValueError) as e:
+            self.log("ls error:", e)
+            return getattr(e, "Status", 1), str(e), [], []
+        return 0, "", files, dirs
+
+    def ls_input(self):
         status, error, files, _ = self.do_ls(self.Location)
         if status:
             return None, error
-        return [
-            desc for desc in files
-            if any(fnmatch.fnmatch(desc.Name, pattern) for pattern in self.FilenamePatterns + self.MetadataPatterns) 
-        ], None
+        return [desc for desc in files if self.Source.matches(desc)], None
+
+    def quarantine_locations(self):
+        return [self.Source.quarantine_location()]
+
+    #
+    # Event-driven mode: the files are sent to the receiver as soon as both the data and the metadata files are
+    # closed after writing or renamed into the watched directories. The periodic scan remains as a safety net
+    #
+
+    def start_watch(self):
+        try:
+            self.INotify = INotify()
+            self.add_watch(self.Location)
+        except OSError as e:
+            self.error("can not watch the location, using periodic scans only:", e)
+            if self.INotify is not None:
+                self.INotify.close()
+            self.INotify = None
+        else:
+            self.log("watching", len(self.WatchedDirs), "directories")
+
+    def add_watch(self, path):
+        wd = self.INotify.add_watch(path, self.WatchMask)
+        self.WatchedDirs[wd] = path
+        if self.WatchRecursive:
+            for entry in os.scandir(path):
+                if entry.is_dir(follow_symlinks=False):
+                    self.add_watch(entry.path)
+
+    def new_directory(self, path):
+        # the files could be created in the new directory before the watch was added
+        try:
+            self.add_watch(path)
+            for entry in os.scandir(path):
+                if entry.is_file(follow_symlinks=False):
+                    self.file_closed(path, entry.name)
+        except OSError as e:
+            self.error(f"can not watch {path}:", e)
+            self.RescanNeeded = True
+
+    def file_closed(self, dir_path, name):
+        data_name = self.Source.data_name(name)
+        if data_name is None:
+            return
+        data_path = dir_path + "/" + data_name
+        try:
+            data_size = os.stat(data_path).st_size
+            meta_size = os.stat(data_path + self.Source.MetaSuffix).st_size
+        except FileNotFoundError:
+            return              # the other file of the pair is not there yet
+        if meta_size == 0:
+            return
+        sizes = (data_size, meta_size)
+        if self.Source.Snapshot.reported(data_name) != sizes:
+            desc = self.file_descriptor(self.Location, data_path, data_size)
+            desc.Source = self.Source
+            self.Source.Snapshot.report(data_name, sizes)
+            self.debug("sending on event:", desc)
+            self.Receiver.add_files({data_name: desc})
+
+    def file_removed(self, name):
+        data_name = self.Source.data_name(name)
+        if data_name is not None and self.Source.Snapshot.forget(data_name):
+            self.Receiver.remove_files([data_name])
+
+    def process_events(self, events):
+        for wd, mask, cookie, name in events:
+            if mask & INotify.IN_Q_OVERFLOW:
+                self.log("inotify event queue overflow, rescan needed")
+                self.RescanNeeded = True
+                continue
+            if mask & INotify.IN_IGNORED:
+                self.WatchedDirs.pop(wd, None)          # the directory was removed
+                continue
+            dir_path = self.WatchedDirs.get(wd)
+            if dir_path is None or not name:
+                continue
+            if mask & INotify.IN_ISDIR:
+                if self.WatchRecursive and mask & (INotify.IN_CREATE | INotify.IN_MOVED_TO):
+                    self.new_directory(dir_path + "/" + name)
+            elif mask & (INotify.IN_CLOSE_WRITE | INotify.IN_MOVED_TO):
+                self.file_closed(dir_path, name)
+            elif mask & (INotify.IN_DELETE | INotify.IN_MOVED_FROM):
+                self.file_removed(name)
+
+    def rescan(self):
+        if self.Receiver.low_water():
+            # files found in the subdirectories by the recursive watch would be taken as removed otherwise
+            files = self.iter_ls_tree(self.Location) if self.Watch and self.WatchRecursive else self.iter_ls(self.Location)
+            self.Source.scan(files, self.Receiver)
+        else:
+            self.log("scan is not needed as the receiver is above the low water mark")
 
     def run(self):
+        if self.Watch:
+            self.start_watch()
+        next_scan = time.time()
         while not self.Stop:
-            if self.Receiver.low_water():
-                data_files = {}         # name -> desc
-                metadata_files = set()  # data file names correspoinding to the metadata names
-                try: 
-                    files, error = self.ls_files()
-                except:
-                    self.log("ls traceback:", "".join(traceback.format_exc()))
-                if error:
-                    self.log("ls error:", error)
-                else:
-                    self.debug("scanner returned %d file descriptors" % (len(files,)))
-                    #for f in files:
-                    #    print(f)
-
-                    out_files = {}
-
-                    for desc in files:
-                        if any(fnmatch.fnmatch(desc.Name, pattern) for pattern in self.FilenamePatterns):
-                            meta_name = desc.Name + self.MetaSuffix
-                            if desc.Name in metadata_files:
-                                out_files[desc.Name] = desc
-                            else:
-                                data_files[desc.Name] = desc
-                        elif any(fnmatch.fnmatch(desc.Name, pattern) for pattern in self.MetadataPatterns) and desc.Size > 0:
-                            data_name = desc.Name[:-len(self.MetaSuffix)]
-                            data_desc = data_files.get(data_name)
-                            if data_desc is not None:
-                                out_files[data_name] = data_desc
-                            else:
-                                metadata_files.add(data_name)
-
-                    self.log("found %d matching files" % (len(out_files),))
-            
-                    if out_files:
-                        #self.debug("sending files:")
-                        #for fn, desc in out_files.items():
-                        #    self.debug(desc.Path, fn)
-                        self.Receiver.add_files(out_files)
+            if self.RescanNeeded or time.time() >= next_scan:
+                self.RescanNeeded = False
+                self.rescan()
+                next_scan = time.time() + self.Interval
+            if self.Stop:
+                break
+            wait = max(0.0, next_scan - time.time())
+            if self.INotify is not None:
+                self.process_events(self.INotify.read(min(wait, self.MaxWatchWait)))
             else:
-                self.log("scan is not needed as the receiver is above the low water mark")
-
-            if not self.Stop:
-                self.sleep(self.Interval)
+                self.sleep(wait)
+        if self.INotify is not None:
+            self.INotify.close()
@@ -1,7 +1,94 @@
 from metacat.webapi import MetaCatClient
+from batching import Batcher
+from client_pool import ClientPool, shared
 
 def client(config):
     if "metacat_url" in config:
         return MetaCatClient(config.get("metacat_url"))
     else:
         return None
+
+def pool_size(config):
+    # number of batches declared concurrently, one client each
+    return config.get("metacat_pool_size", 5)
+
+def client_pool(config):
+    # returns the process-wide pool of MetaCat clients for the URL
+    if "metacat_url" in config:
+        return shared(("metacat", config["metacat_url"]),
+            lambda: ClientPool(lambda: client(config), pool_size(config), name="MetaCatClientPool"))
+    else:
+        return None
+
+class MetaCatDeclarer(Batcher):
+    """
+    Aggregates MetaCat declarations from concurrent MoverTasks. Files are grouped by the MetaCat dataset.
+    For each batch, existing files are looked up with a single get_files() call and the missing files
+    are declared with a single declare_files() call.
+
+    The result for each submitted file is a tuple (status, file_info), where status is either "exists"
+    or "declared" and file_info is the MetaCat file info dictionary.
+    """
+
+    def __init__(self, config):
+        Batcher.__init__(self, "MetaCatDeclarer",
+            max_size = config.get("metacat_batch_size"),
+            max_delay = config.get("metacat_batch_delay"),
+            workers = pool_size(config)
+        )
+        self.Config = config
+        self.ClientPool = client_pool(config)
+
+    def declare(self, dataset_did, file_info, timeout=None):
+        # file_info: {"namespace":..., "name":..., "fid":..., "metadata":..., "size":..., "checksums":...}
+        return self.submit(dataset_did, file_info).wait(timeout)
+
+    def process_batch(self, dataset_did, files):
+        with self.ClientPool.client() as client:
+            return self.declare_batch(client, dataset_did, files)
+
+    def declare_batch(self, client, dataset_did, files):
+        dids = ["%(namespace)s:%(name)s" % f for f in files]
+        existing = {
+            "%(namespace)s:%(name)s" % info: info
+            for info in client.get_files([{"did": did} for did in dids], with_metadata=False, with_provenance=False)
+        }
+        to_declare = [f for did, f in zip(dids, files) if did not in existing]
+        declared = self.declare_files(client, dataset_did, to_declare) if to_declare else {}
+        self.log("batch for dataset %s: %d files, %d already existed, %d declared" % (
+            dataset_did, len(files), len(existing), len(to_declare)))
+        results = []
+        for did in dids:
+            if did in existing:
+                results.append(("exists", existing[did]))
+            else:
+                result = declared.get(did) or RuntimeError(f"{did} was not declared")
+                results.append(result if isinstance(result, Exception) else ("declared", result))
+        return results
+
+    def declare_files(self, client, dataset_did, files):
+        # returns {did: file_info or Exception}
+        try:
+            declared = client.declare_files(dataset_did, [self.declare_dict(f) for f in files])
+        except Exception as e:
+            if len(files) == 1:
+                return {"%(namespace)s:%(name)s" % files[0]: e}
+            # declare one by one to isolate the failing file(s)
+            self.log("bulk declaration of %d files to %s failed: %s. Will declare one by one" % (len(files), dataset_did, e))
+            out = {}
+            for f in files:
+                out.update(self.declare_files(client, dataset_did, [f]))
+            return out
+        return {"%(namespace)s:%(name)s" % info: info for info in declared}
+
+    def declare_dict(self, f):
+        out = dict(
+            namespace = f["namespace"],
+            name = f["name"],
+            metadata = f["metadata"],
+            size = f["size"],
+            checksums = f["checksums"]
+        )
+        if f.get("fid") is not None:
+            out["fid"] = str(f["fid"])
+        return out
@@ -1,10 +1,16 @@
-from pythreader import PyThread, synchronized, Primitive, Task, TaskQueue
-from tools import runCommand
-import json, hashlib, traceback, time, os, pprint, textwrap
+from pythreader import PyThread, synchronized, Primitive, Task
+from tools import FIFOTaskQueue
+import json, hashlib, traceback, time, os, pprint, textwrap, re, heapq
 import rucio_client, metacat_client, samweb_client
 from samweb_client import SAMDeclarationError
+from rucio_client import RucioDatasetError
 from logs import Logged
-from xrootd_scanner import XRootDScanner
+import storage
+from prefetcher import MetadataPrefetcher
+from batching import expecting
+from concurrency import ConcurrencyController
+from storage import StorageError
+from listing import FileListing
 from lfn2pfn import lfn2pfn
 from datetime import datetime, timezone
 
@@ -15,13 +21,17 @@ if pythreader_version_info < (2,15,0):
 class MoverTask(Task, Logged):
     
     RequiredMetadata = ["checksum", "file_size", "runs"]
+    Adler32RE = re.compile(r"(adler32:)?[0-9a-fA-F]{1,8}")
     DefaultMetaSuffix = ".json"
+    DefaultMaxMetadataSize = 10*1024*1024
     
-    def __init__(self, config, filedesc):
+    def __init__(self, config, filedesc, metacat_declarer=None, rucio_declarer=None):
         Task.__init__(self, filedesc)
         Logged.__init__(self, name=f"MoverTask[{filedesc.Name}]")
         self.FileDesc = filedesc
         self.Config = config
+        self.MetaCatDeclarer = metacat_declarer
+        self.RucioDeclarer = rucio_declarer
         self.MetaSuffix = config.get("meta_suffix", ".json")
         self.RucioConfig = config.get("rucio", {})
         self.SAMConfig = config.get("samweb", {})
@@ -34,6 +44,11 @@ class MoverTask(Task, Logged):
         self.DstRootPath = config["destination_root_path"]
         
         self.TransferTimeout = config.get("transfer_timeout", 120)
+        self.VerifyChecksum = config.get("verify_checksum", True)
+        self.MaxMetadataSize = config.get("max_metadata_size", self.DefaultMaxMetadataSize)
+        self.Storage = storage.backend(config)
+        self.DirCache = storage.directory_cache(config)
+        self.DestState = storage.destination_state(config)
         self.LowecaseMetadataNames = config.get("lowercase_meta_names", False)
         self.Error = None
         self.Failed = False
@@ -41,6 +56,10 @@ class MoverTask(Task, Logged):
         self.EventLog = []              # [(event, t, info), ...]
         self.EventDict = {}
         self.RetryAfter = None          # do not resubmit until this time
+        self.Metadata = None            # validated metadata, if prefetched
+        # set by the fetch stage for the following stages
+        self.MetaCatMeta = self.FileScope = self.FileSize = self.Adler32 = None
+        self.MetaPath = self.SrcDataPath = self.DestDataPath = self.DestRelPath = None
         self.KeepUntil = None           # keep in memory until this time
         self.DefaultCategory = config.get("default_category")       # default metadata category for unexpeted uncategorized metadata attrs
         self.timestamp("created")
@@ -192,53 +211,47 @@ class MoverTask(Task, Logged):
         return '%s/%s/%s/%s' % (scope, hstr[0:2], hstr[2:4], name)
         
     def get_file_size(self, server, path):
-        scanner = XRootDScanner(server, self.Config["scanner"])
-        return scanner.getFileSize(path)
+        if self.DestState is not None:
+            return self.DestState.size(server, path)
+        return self.Storage.stat(server, path)
 
-    def run(self):
-        #self.debug("started")
-        self.timestamp("started")
-        self.Failed = False
-        self.Error = None
-        self.TaskStarted = time.time()
-        #self.debug("time:", time.time())
-        
-        filename, relpath = self.FileDesc.Name, self.FileDesc.RelPath
-        self.debug("FileDescritor:", self.FileDesc)
+    def create_dirs(self, path):
+        self.timestamp("creating dirs")
+        try:
+            self.Storage.mkdir(self.DestServer, path)
+        except StorageError as e:
+            self.debug("create dirs failed (will be ignored assuming it already exists): %s" % (e,))
+        else:
+            if self.DirCache is not None:
+                self.DirCache.add(self.DestServer, path)
 
+    def load_metadata(self):
         #
-        # Get metadata and parse
+        # Fetches, parses and validates the metadata file.
+        # Returns (metadata, error, quarantine). If error is not None, quarantine tells whether the file
+        # has to be quarantined or can be retried later
         #
-        
-        meta_suffix = self.Config.get("meta_suffix", self.DefaultMetaSuffix)
-        meta_tmp = self.Config.get("temp_dir", "/tmp") + "/" + self.FileDesc.Name + meta_suffix
-        meta_path = self.FileDesc.path(self.SrcRootPath) + meta_suffix
-        download_cmd = self.Config["download_command_template"] \
-            .replace("$server", self.SourceServer) \
-            .replace("$src_path", meta_path) \
-            .replace("$dst_path", meta_tmp)
-        self.debug("download command:", download_cmd)
-
-        self.timestamp("downloading metadata")
-
-        ret, output = runCommand(download_cmd, self.TransferTimeout, self.debug)
-        self.debug("metadata download command:", download_cmd)
-        if ret:
-            return self.failed("Metadata download failed: %s" % (output,))
-        
+        meta_path = self.FileDesc.path(self.SrcRootPath) + self.MetaSuffix
+
+        self.timestamp("fetching metadata")
+        t0 = time.time()
         try:
-            metadata = json.load(open(meta_tmp, "r"))
+            meta_bytes = self.Storage.read(self.SourceServer, meta_path, self.MaxMetadataSize)
+        except StorageError as e:
+            return None, "Metadata download failed: %s" % (e,), False
+
+        try:
+            metadata = json.loads(meta_bytes)
         except Exception as e:
-            return self.failed(f"Metadata loading error: {e}")
-        finally:
-            os.remove(meta_tmp)
+            return None, f"Metadata loading error: {e}", False
+        self.timestamp("metadata fetched", "%d bytes in %.3f seconds" % (len(meta_bytes), time.time() - t0))
 
         # strip whitespace from around the attribute names
         metadata = {key.strip():value for key, value in metadata.items()}
 
         for x in self.RequiredMetadata:
             if x not in metadata:
-                return self.quarantine(f"{x} missing from metadata")
+                return None, f"{x} missing from metadata", True
 
         #
         # Check file size
@@ -246,35 +259,80 @@ class MoverTask(Task, Logged):
         file_size = metadata["file_size"]
 
         if not isinstance(file_size, int) or file_size <= 0:
-            return self.quarantine(f"Invalid file size in metadata: {file_size}")
+            return None, f"Invalid file size in metadata: {file_size}", True
         
         if file_size != self.FileDesc.Size:
-            return self.failed(f"Scanned file size {self.FileDesc.Size} differs from metadata: {file_size}")
+            return None, f"Scanned file size {self.FileDesc.Size} differs from metadata: {file_size}", False
+
+        #
+        # Check checksum
+        #
+        checksum = metadata["checksum"]
+        if not isinstance(checksum, str) or not self.Adler32RE.fullmatch(checksum.strip()):
+            return None, f"Invalid adler32 checksum in metadata: {checksum}", True
 
         #
         # Convert to MetaCat format
         #
         try:
-            metacat_meta = self.metacat_metadata(self.FileDesc, metadata)   # massage meta if needed
+            self.metacat_metadata(self.FileDesc, metadata)   # massage meta if needed
         except Exception as e:
-            return self.quarantine(f"Error converting metadata to MetaCat: {e}")
+            return None, f"Error converting metadata to MetaCat: {e}", True
 
-        try:    file_scope = self.file_scope(self.FileDesc, metadata)
+        try:    self.file_scope(self.FileDesc, metadata)
         except Exception as e:
-            return self.quarantine("can not get file scope. Error: %s. Metadata runs: %s" % (metadata.get("runs"),))
-            
-        did = file_scope + ":" + filename
+            return None, "can not get file scope. Error: %s. Metadata runs: %s" % (e, metadata.get("runs")), True
+
+        return metadata, None, False
+
+    Stages = ("fetch", "transfer", "declare", "cleanup")
+
+    def run(self):
+        # runs all the stages in the current thread
+        for stage in self.Stages:
+            if not self.run_stage(stage):
+                break
+
+    def run_stage(self, stage):
+        # returns True if the task can proceed to the next stage
+        return getattr(self, "stage_" + stage)()
+
+    def stage_fetch(self):
+        #self.debug("started")
+        self.timestamp("started")
+        self.Failed = False
+        self.Error = None
+        self.TaskStarted = time.time()
+        #self.debug("time:", time.time())
+        
+        filename, relpath = self.FileDesc.Name, self.FileDesc.RelPath
+        self.debug("FileDescritor:", self.FileDesc)
+
+        #
+        # Get metadata and parse, unless already prefetched
+        #
+        
+        self.MetaPath = self.FileDesc.path(self.SrcRootPath) + self.MetaSuffix
+        metadata = self.Metadata
+        if metadata is None:
+            metadata, error, quarantine = self.load_metadata()
+            if error:
+                return self.quarantine(error) if quarantine else self.failed(error)
+            self.Metadata = metadata
+
+        self.FileSize = metadata["file_size"]
+        self.MetaCatMeta = metacat_meta = self.metacat_metadata(self.FileDesc, metadata)
+        self.FileScope = file_scope = self.file_scope(self.FileDesc, metadata)
             
         adler32_checksum = metadata["checksum"]
         if ':' in adler32_checksum:
             type, value = adler32_checksum.split(':', 1)
             assert type == "adler32"
             adler32_checksum = value
-        dataset_scope = self.dataset_scope(self.FileDesc, metadata)
-        
+        self.Adler32 = adler32_checksum
 
         # EOS expects URL to have double slashes: root://host:port//path/to/file
-        src_data_path = self.FileDesc.path(self.SrcRootPath)
+        self.SrcDataPath = self.FileDesc.path(self.SrcRootPath)
         rel_path_function = self.Config.get("rel_path_function")
         dest_root_path = self.DstRootPath
         self.debug("")
@@ -289,10 +347,14 @@ class MoverTask(Task, Logged):
             dest_rel_path = self.Config["rel_path_pattern"] % meta_dict
         else:
             raise ValueError(f"Unknown relative path function {rel_path_function}. Accepted: hash or template")
-        dest_data_path = dest_root_path + "/" + dest_rel_path
+        self.DestRelPath = dest_rel_path
+        self.DestDataPath = dest_root_path + "/" + dest_rel_path
+        return True
+
+    def stage_transfer(self):
+        file_size = self.FileSize
+        src_data_path, dest_data_path, dest_rel_path = self.SrcDataPath, self.DestDataPath, self.DestRelPath
         dest_dir_abs_path = dest_data_path.rsplit("/", 1)[0]  
-        data_dst_url = "root://" + self.DestServer + "/" + dest_data_path     
-        data_src_url = "root://" + self.SourceServer + "/" + src_data_path
         
         #
         # check if the dest data file exists and has correct size
@@ -307,42 +369,87 @@ class MoverTask(Task, Logged):
         #if dest_size is not None:
         #    self.debug(f"data file exists at the destination {dest_data_path}, size: {dest_size}")
 
+
         do_move_files = self.Config.get("move_files", True)
-        if dest_size != file_size:
-            if dest_size is not None:
+        copy_needed = dest_size != file_size
+        if not copy_needed and self.VerifyChecksum:
+            # same size, make sure it is the same file
+            try:
+                dest_checksum = self.Storage.checksum(self.DestServer, dest_data_path)
+            except StorageError as e:
+                return self.failed(f"Can not get checksum at the destination: {e}")
+            if dest_checksum is not None and not self.Storage.same_checksum(dest_checksum, self.Adler32):
+                self.log(f"destination file exists but has incorrect checksum {dest_checksum} vs. {self.Adler32}")
+                copy_needed = True
+
+        if copy_needed:
+            if dest_size is not None and dest_size != file_size:
                 self.log(f"destination file exists but has incorrect size {dest_size} vs. {file_size}")
 
             #
             # copy data
             #
-            self.timestamp("creating dirs")
-            create_dirs_command = self.Config["create_dirs_command_template"]   \
-                .replace("$server", self.DestServer)    \
-                .replace("$path", dest_dir_abs_path)
-            #self.debug("create dirs command:", create_dirs_command)
-
-            ret, output = runCommand(create_dirs_command, self.TransferTimeout, self.debug)
-            #if ret:
-            #    self.debug("create dirs failed (will be ignored assuming it already exists): %s" % (output,))
-
-            copy_cmd = self.Config["copy_command_template"] \
-                .replace("$dst_url", data_dst_url)  \
-                .replace("$src_url", data_src_url)  \
-                .replace("$dst_data_path", dest_data_path)   \
-                .replace("$src_data_path", src_data_path)   \
-                .replace("$dst_rel_path", dest_rel_path)
-            #self.debug("copy command:", copy_cmd)
+            dir_known = self.DirCache is not None and self.DirCache.exists(self.DestServer, dest_dir_abs_path)
+            if not dir_known:
+                self.create_dirs(dest_dir_abs_path)
 
             self.timestamp("transferring data")
 
-            #self.debug("copy command:", copy_cmd)
-            ret, output = runCommand(copy_cmd, self.TransferTimeout, self.debug)
-            if ret:
-                return self.failed("Data copy failed: %s" % (output,))
+            try:
+                checksum = self.Storage.copy(self.SourceServer, src_data_path, self.DestServer, dest_data_path, dest_rel_path)
+            except StorageError as e:
+                if not (dir_known and storage.is_missing_directory(e)):
+                    return self.failed("Data copy failed: %s" % (e,))
+                # the cached directory is gone
+                self.log(f"destination directory {dest_dir_abs_path} not found. Will create and retry")
+                self.DirCache.remove(self.DestServer, dest_dir_abs_path)
+                self.create_dirs(dest_dir_abs_path)
+                self.timestamp("transferring data")
+                try:
+                    checksum = self.Storage.copy(self.SourceServer, src_data_path, self.DestServer, dest_data_path, dest_rel_path)
+                except StorageError as e:
+                    return self.failed("Data copy failed: %s" % (e,))
+            if self.DirCache is not None:
+                self.DirCache.add(self.DestServer, dest_dir_abs_path)
+            if self.DestState is not None:
+                self.DestState.update(self.DestServer, dest_data_path, file_size)
 
             self.log("data transfer complete")
+
+            if self.VerifyChecksum:
+                error = self.verify_checksum(dest_data_path, checksum)
+                if error:
+                    return self.failed(error)
         else:
-            self.log("data file already exists at the destination and has correct size. Not overwriting")
+            self.log("data file already exists at the destination and has correct size and checksum. Not overwriting")
+        return True
+
+    def verify_checksum(self, path, checksum=None):
+        # checksum - destination file checksum if it was computed during the copy. Returns error or None
+        if checksum is None:
+            try:
+                checksum = self.Storage.checksum(self.DestServer, path)
+            except StorageError as e:
+                return f"Can not get checksum at the destination: {e}"
+            if checksum is None:
+                self.debug("destination checksum is not available, not verified")
+                return None
+        if not self.Storage.same_checksum(checksum, self.Adler32):
+            return f"Destination checksum {checksum} differs from metadata: {self.Adler32}"
+        self.log("destination checksum verified:", checksum)
+
+    def stage_declare(self):
+        # the declarers flush their batches once all the files in the declare stage are submitted
+        with expecting(self.RucioDeclarer):
+            with expecting(self.MetaCatDeclarer):
+                ok = self.declare_to_sam_and_metacat()
+            return ok and self.declare_to_rucio()
+
+    def declare_to_sam_and_metacat(self):
+        filename = self.FileDesc.Name
+        metadata, metacat_meta, file_scope, file_size = self.Metadata, self.MetaCatMeta, self.FileScope, self.FileSize
+        adler32_checksum = self.Adler32
+        dest_data_path, dest_rel_path = self.DestDataPath, self.DestRelPath
 
         #
         # Do the declarations
@@ -420,120 +527,79 @@ class MoverTask(Task, Logged):
         #
         # declare to MetaCat
         #
-        mclient = metacat_client.client(self.Config)
         do_declare_to_metacat = self.Config.get("declare_to_metacat", True)
-        if mclient is not None:
+        if self.MetaCatDeclarer is not None:
             if do_declare_to_metacat:
                 self.timestamp("declaring to MetaCat")
-                existing_metacat = mclient.get_file(did=did)
-                if existing_metacat:
-                    if existing_metacat["size"] != file_size or existing_metacat.get("checksums", {}).get("adler32") != adler32_checksum:
-                        self.quarantine("already declared to MetaCat with different size and/or checksum")
+                dataset_did = self.metacat_dataset(self.FileDesc, metadata)
+                file_info = {
+                        "namespace":    file_scope,
+                        "name":         filename,
+                        "fid":          file_id,
+                        "metadata":     metacat_meta,
+                        "size":         file_size,
+                        "checksums":    {   "adler32":  adler32_checksum   },
+                    }
+                try:
+                    status, metacat_info = self.MetaCatDeclarer.declare(dataset_did, file_info, timeout=self.TransferTimeout)
+                except Exception as e:
+                    return self.failed(f"MetaCat declaration failed: {e}")
+                if status == "exists":
+                    if metacat_info["size"] != file_size or metacat_info.get("checksums", {}).get("adler32") != adler32_checksum:
+                        return self.quarantine("already declared to MetaCat with different size and/or checksum")
                     else:
                         self.log("already declared to MetaCat")
                 else:
-                    dataset_did = self.metacat_dataset(self.FileDesc, metadata)
-                    metacat_meta = self.metacat_metadata(self.FileDesc, metadata)   # massage meta if needed
-                    file_info = {
-                            "namespace":    file_scope,
-                            "name":         filename,
-                            "metadata":     metacat_meta,
-                            "size":         file_size,
-                            "checksums":    {   "adler32":  adler32_checksum   },
-                        }
-                    if file_id is not None:
-                        file_info["fid"] = str(file_id)
-                    #print("about to call mclient.declare_files with file_info:", file_info)
-                    try:    
-                        file_info = mclient.declare_file(
-                            fid=file_id, namespace=file_scope, name=filename, 
-                            metadata=metacat_meta, 
-                            dataset_did=dataset_did,
-                            size=file_size, checksums={ "adler32":  adler32_checksum }
-                        )
-                    except Exception as e:
-                        return self.failed(f"MetaCat declaration failed: {e}")
                     self.log("file declared to MetaCat")
             else:
                 self.debug("would declare to MetaCat")
                 self.debug("Name, namespace, fid:", filename, file_scope, file_id)
                 self.debug(json.dumps(metacat_meta, indent=2, sort_keys=True))
+        return True
 
-        #
-        # declare to Rucio
-        #
-        rclient = rucio_client.client(self.RucioConfig)
-        do_declare_to_rucio = self.RucioConfig.get("declare_to_rucio", True)
-        if rclient is not None:
-            if do_declare_to_rucio:
-                from rucio.common.exception import DataIdentifierAlreadyExists, DuplicateRule, FileAlreadyExists
-                #print(rclient.whoami())
-
-                self.timestamp("declaring to Rucio")
-
-                # create dataset if does not exist
-                dataset_scope, dataset_name = self.undid(self.rucio_dataset_did(self.FileDesc, metadata))
-                try:    rclient.add_did(dataset_scope, dataset_name, "DATASET")
-                except DataIdentifierAlreadyExists:
-                    pass
-                except Exception as e:
-                    return self.quarantine(f"Error in creating Rucio dataset {dataset_scope}:{dataset_name}: {e}")
-                
-                else:
-                    self.log(f"Rucio dataset {dataset_scope}:{dataset_name} created")
-
-                for target_rse in self.RucioConfig["target_rses"]:
-                    try:
-                        rclient.add_replication_rule([{"scope":dataset_scope, "name":dataset_name}], 1, target_rse)
-                    except DuplicateRule:
-                        pass
-                    except Exception as e:
-                        return self.quarantine(f"Error in creating Rucio replication rule -> {target_rse}: {e}")
-                    else:
-                        self.log(f"replication rule -> {target_rse} created")
-            
-                # declare file replica to Rucio
-                drop_rse = self.RucioConfig["drop_rse"]
-                rclient.add_replica(drop_rse, file_scope, filename, file_size, adler32_checksum)
-                self.log(f"File replica declared in drop rse {drop_rse}")
-
-                # add the file to the dataset
-                try:
-                    rclient.attach_dids(dataset_scope, dataset_name, [{"scope":file_scope, "name":filename}])
-                except FileAlreadyExists:
-                    self.log("File was already attached to the Rucio dataset")
-                else:
-                    self.log("File attached to the Rucio dataset")
-            else:
-                self.debug("would declare to Rucio")
+    def declare_to_rucio(self):
+        filename, metadata, file_scope, file_size = self.FileDesc.Name, self.Metadata, self.FileScope, self.FileSize
+        adler32_checksum = self.Adler32
+        if self.RucioDeclarer is not None:
+            self.timestamp("declaring to Rucio")
+            dataset_scope, dataset_name = self.undid(self.rucio_dataset_did(self.FileDesc, metadata))
+            try:
+                self.RucioDeclarer.declare(dataset_scope, dataset_name, file_scope, filename, file_size, adler32_checksum,
+                        timeout=self.TransferTimeout)
+            except RucioDatasetError as e:
+                return self.quarantine(str(e))
+            except Exception as e:
+                return self.failed(f"Rucio declaration failed: {e}")
+            self.log(f"File replica declared in drop rse {self.RucioDeclarer.DropRSE} and attached to the Rucio dataset {dataset_scope}:{dataset_name}")
+        else:
+            self.debug("would declare to Rucio")
+        return True
 
+    def stage_cleanup(self):
+        meta_path, src_data_path = self.MetaPath, self.SrcDataPath
         self.timestamp("removing sources")
 
         do_remove_sources = self.Config.get("remove_sources", True)
 
-        rmcommand = self.Config["delete_command_template"]	\
-            .replace("$server", self.SourceServer)	\
-            .replace("$path", meta_path)
         if do_remove_sources:
-            ret, output = runCommand(rmcommand, self.TransferTimeout, self.debug)
-            if ret:
-                return self.failed("Remove source metadata failed: %s" % (output,))
+            try:
+                self.Storage.remove(self.SourceServer, meta_path)
+            except StorageError as e:
+                return self.failed("Remove source metadata failed: %s" % (e,))
         else:
-            self.debug("would remove source metadata:", rmcommand)
+            self.debug("would remove source metadata:", meta_path)
 
-        rmcommand = self.Config["delete_command_template"]	\
-            .replace("$server", self.SourceServer)	\
-            .replace("$path", src_data_path)
         if do_remove_sources:
-            ret, output = runCommand(rmcommand, self.TransferTimeout, self.debug)
-            if ret:
-                return self.failed("Remove source ata failed: %s" % (output,))
-
+            try:
+                self.Storage.remove(self.SourceServer, src_data_path)
+            except StorageError as e:
+                return self.failed("Remove source data failed: %s" % (e,))
         else:
-            self.debug("would remove source data file:", rmcommand)
+            self.debug("would remove source data file:", src_data_path)
 
         self.Manager = None
         self.timestamp("complete")
+        return True
 
     @synchronized
     def timestamp(self, event, info=None):
@@ -561,121 +627,351 @@ class MoverTask(Task, Logged):
             src_path = self.FileDesc.path(self.SrcRootPath)
             meta_path = src_path + self.MetaSuffix
             qmeta_path = self.QuarantineLocation + "/" + self.FileDesc.Name + self.MetaSuffix
-            cmd = "xrdfs %s mv %s %s" % (
-                self.FileDesc.Server,
-                meta_path, qmeta_path
-            )
-            ret, output = runCommand(cmd, self.TransferTimeout, self.debug)
-            if ret:
-                return self.failed("Quarantine for metadata file %s failed: %s" % (self.FileDesc.Name + self.MetaSuffix, output))
+            try:
+                self.Storage.rename(self.FileDesc.Server, meta_path, qmeta_path)
+            except StorageError as e:
+                return self.failed("Quarantine for metadata file %s failed: %s" % (self.FileDesc.Name + self.MetaSuffix, e))
 
             # quarantine the data file
             path = src_path
             qpath = self.QuarantineLocation + "/" + self.FileDesc.Name
-            cmd = "xrdfs %s mv %s %s" % (
-                self.FileDesc.Server,
-                path, qpath
-            )
-            ret, output = runCommand(cmd, self.TransferTimeout, self.debug)
-            if ret:
-                return self.failed("Quarantine for data file %s failed: %s" % (self.FileDesc.Name, output))
+            try:
+                self.Storage.rename(self.FileDesc.Server, path, qpath)
+            except StorageError as e:
+                return self.failed("Quarantine for data file %s failed: %s" % (self.FileDesc.Name, e))
 
             self.timestamp("quarantined", self.Error)
             
         else:
             raise ValueError("Quarantine directory unspecified")
 
+class StageTask(Task):
+    #
+    # Runs one stage of the MoverTask in the stage's TaskQueue. If the stage succeeds, the mover is passed to the next
+    # stage. This blocks while the next stage queue is full, so that the slower stage holds back the faster one
+    #
+
+    def __init__(self, mover, stage, manager):
+        Task.__init__(self, f"{stage}:{mover.name}")
+        self.Mover = mover
+        self.Stage = stage
+        self.Manager = manager
+
+    def run(self):
+        if self.Mover.Started is None:
+            self.Mover.Started = time.time()
+        ok = self.Mover.run_stage(self.Stage)
+        if ok:
+            self.Manager.next_stage(self.Mover, self.Stage)
+        return ok
+
 class Manager(PyThread, Logged):
     
     DEFAULT_LOW_WATER_MARK = 5
+    DEFAULT_STAGE_BACKLOG = 20
+    DEFAULT_CREDITS = 500
+    DEFAULT_RUN_NUMBER_RE = r"run(\d+)"
+    FEED_ORDERS = ("oldest", "smallest", "run")
     
     def __init__(self, config, history_db):
         PyThread.__init__(self, name="Mover")
         Logged.__init__(self, name="Mover")
         self.Config = config
-        capacity = None             # config.get("queue_capacity") possible deadlock otherwise
         max_movers = config.get("max_movers", 10)
         stagger = config.get("stagger", 0.2)
-        self.TaskQueue = TaskQueue(max_movers, capacity=capacity, stagger=stagger, delegate=self)
+        pipeline_config = config.get("pipeline") or {}
+        backlog = pipeline_config.get("backlog", self.DEFAULT_STAGE_BACKLOG)
+        self.StageQueues = {}               # stage -> TaskQueue
+        for stage in MoverTask.Stages:
+            nworkers = pipeline_config.get(stage, max_movers)
+            # fetch queue capacity is not limited because add_files() would block the scanner otherwise
+            capacity = None if stage == MoverTask.Stages[0] else nworkers + backlog
+            self.StageQueues[stage] = FIFOTaskQueue(nworkers, capacity=capacity, 
+                stagger=stagger if stage == "transfer" else 0.0, delegate=self, name=f"{stage}_queue")
+        adaptive_config = config.get("adaptive_concurrency") or {}
+        self.ConcurrencyController = None
+        if adaptive_config.get("enabled", False):
+            self.ConcurrencyController = ConcurrencyController(self.StageQueues["transfer"], adaptive_config,
+                pipeline_config.get("transfer", max_movers), backlog=backlog)
         self.RetryCooldown = int(config.get("retry_cooldown", 300))
         self.TaskKeepInterval = int(config.get("keep_interval", 24*3600))
         self.LowWaterMark = config.get("low_water_mark", self.DEFAULT_LOW_WATER_MARK)
+        feeding_config = config.get("feeding") or {}
+        self.Credits = feeding_config.get("credits", self.DEFAULT_CREDITS)          # max files in progress, None - unlimited
+        self.FeedOrder = feeding_config.get("order", "oldest")
+        if self.FeedOrder not in self.FEED_ORDERS:
+            raise ValueError(f"Unknown feeding order: {self.FeedOrder}. Must be one of: {', '.join(self.FEED_ORDERS)}")
+        self.RunNumberRE = re.compile(feeding_config.get("run_number_re", self.DEFAULT_RUN_NUMBER_RE), re.I)
         self.HistoryDB = history_db
+        self.MetaCatDeclarer = metacat_client.MetaCatDeclarer(config) if "metacat_url" in config else None
+        rucio_config = config.get("rucio", {})
+        self.RucioDeclarer = rucio_client.RucioDeclarer(rucio_config) if rucio_config.get("declare_to_rucio", True) else None
+        prefetch_config = config.get("prefetch", {})
+        self.Prefetcher = MetadataPrefetcher(prefetch_config) if prefetch_config.get("workers", MetadataPrefetcher.DefaultWorkers) > 0 else None
+        self.Prefetching = {}               # name -> task, metadata being prefetched, in the order the tasks were started
+        self.Prefetched = set()             # names of the prefetching tasks with the metadata loaded, waiting for the earlier ones
         self.NextRetry = {}	                # name -> t
+        self.RetryPending = {}              # name -> desc or ListingEntry, found by the scanner, waiting to be queued
+        self.FirstSeen = {}                 # name -> time the file was first found by the scanner
         self.RecentTasks = {}               # name -> task
+        self.PersistState = config.get("persist_state", True)
+        if self.PersistState:
+            self.restore_state()
         self.Stop = False
 
     def task(self, name):
         return self.RecentTasks.get(name)
 
+    def restore_state(self):
+        # resume the retry cooldowns of the files processed before restart
+        now = time.time()
+        counts = {}
+        for state in self.HistoryDB.load_state(since=now - max(self.RetryCooldown, self.TaskKeepInterval)):
+            if state.Status in ("done", "failed", "quarantined"):
+                if state.NextRetry is not None and state.NextRetry > now:
+                    self.NextRetry[state.Name] = state.NextRetry
+                    counts[state.Status] = counts.get(state.Status, 0) + 1
+            else:
+                # interrupted by the restart, can be started again right away
+                counts["interrupted"] = counts.get("interrupted", 0) + 1
+        self.log("restored file states:", ", ".join(f"{status}: {n}" for status, n in sorted(counts.items())) or "none")
+
+    def save_state(self, task, status, stage=None, info=None):
+        if self.PersistState:
+            desc = task.FileDesc
+            self.HistoryDB.save_state(desc.Name, status, stage=stage, size=desc.Size, tstart=task.Started,
+                next_retry=self.NextRetry.get(desc.Name, task.RetryAfter), info=info)
+
     def stop(self):
         self.Stop = True
         self.wakeup()
         
-    def quarantined(self):
-        qlocation = self.Config.get("quarantine_location")
-        if not qlocation:
+    def quarantined(self, locations=None):
+        # locations: [(server, quarantine location), ...], default - the configured source server and quarantine location
+        if locations is None:
+            locations = [(self.Config.get("source_server"), self.Config.get("quarantine_location"))]
+        locations = [(server, qlocation) for server, qlocation in locations if qlocation]
+        if not locations:
             return [], "Quarantine not configured"
-        scanner = XRootDScanner(self.Config["source_server"], self.Config["scanner"])
-        error = None
+        errors = []
         files = []
-        try:    files = scanner.scan(qlocation)		# returns file descriptors
-        except Exception as e:
-            error = str(e)
-        return files or [], error
+        backend = storage.backend(self.Config)
+        for server, qlocation in locations:
+            try:    files += backend.ls(server, qlocation)[0]		# returns file descriptors
+            except Exception as e:
+                errors.append(str(e))
+        return files, "\n".join(errors) or None
             
     @synchronized
     def recent_tasks(self):
         return sorted(self.RecentTasks.values(), key=lambda t: -t.last_event()[1] or 0)
         
+    def stage_tasks(self):
+        # returns ([waiting mover, ...], [active mover, ...]) for all stages
+        waiting, active = [], []
+        for queue in self.StageQueues.values():
+            w, a = queue.tasks()
+            waiting += [t.Mover for t in w]
+            active += [t.Mover for t in a]
+        return waiting, active
+
     @synchronized
     def current_transfers(self):
-        waiting, active = self.TaskQueue.tasks()
-        return active + waiting
+        waiting, active = self.stage_tasks()
+        return active + waiting + list(self.Prefetching.values())
 
     def low_water(self):
-        return len(self.TaskQueue) < self.LowWaterMark
+        return sum(len(queue) for queue in self.StageQueues.values()) + len(self.Prefetching) < self.LowWaterMark
+
+    @synchronized
+    def add_files(self, files):
+        # files: FileListing or {name:desc}
+        # the files are queued unless they are already in progress or the retry cooldown has not expired yet
+        # for them. Such files remain pending and are queued later by start_pending()
+        now = time.time()
+        entries = files.entries() if isinstance(files, FileListing) else files.values()
+        for entry in entries:
+            name = entry.Name
+            self.RetryPending[name] = entry            # the latest scan results
+            self.FirstSeen.setdefault(name, now)
+        nqueued = self.start_pending()
+        self.log("%d new files queued out of %d found by the scanner, %d pending" % (nqueued, len(files), len(self.RetryPending)))
+
+    @synchronized
+    def remove_files(self, names):
+        # the files disappeared from the input location
+        for name in names:
+            self.RetryPending.pop(name, None)
+            self.FirstSeen.pop(name, None)
+
+    def priority(self, item):
+        # item: (name, desc or ListingEntry), returns sort key, smaller goes first
+        name, entry = item
+        if self.FeedOrder == "smallest":
+            return (entry.Size, name)
+        elif self.FeedOrder == "run":
+            m = self.RunNumberRE.search(name)
+            return (0, int(m.group(1)), name) if m else (1, 0, name)
+        return (self.FirstSeen.get(name, 0), name)
+
+    @synchronized
+    def in_progress(self):
+        # names of the files being prefetched, queued or moved
+        waiting, active = self.stage_tasks()
+        return set(t.FileDesc.Name for t in waiting + active) | set(self.Prefetching.keys())
+
+    @synchronized
+    def pending_counts(self):
+        # returns (number of pending files, number of them held back by the retry cooldown)
+        now = time.time()
+        return len(self.RetryPending), sum(1 for name in self.RetryPending if self.NextRetry.get(name, 0) > now)
 
     @synchronized
-    def add_files(self, files_dict):
+    def credits(self):
+        # number of files the manager can accept now, None if unlimited
+        if self.Credits is None:
+            return None
+        return max(0, self.Credits - len(self.in_progress()))
+
+    @synchronized
+    def start_pending(self):
         #
         # WARNING: this can cause a deadlock of the queue capacity is limited
         #
-        
-        # files_dict: {name:desc}
-        # purge expired retry-after entries and the list of found but delayed files
-        #self.RetryAfter = dict((name, t) for name, t in self.RetryAfter.items() if t > time.time())
-        #self.Delayed = dict((name, t) for name, t in self.Delayed.items() if t > time.time())
-        waiting, active = self.TaskQueue.tasks()
-        in_progress = set(t.FileDesc.Name for t in waiting + active)
+        in_progress = self.in_progress()
         now = time.time()
         self.NextRetry = {name:t for name, t in self.NextRetry.items() if t > now}
-        nqueued = 0
-        for name, filedesc in files_dict.items():
-            name = filedesc.Name
-            if name not in in_progress and name not in self.NextRetry:
-                task = MoverTask(self.Config, filedesc)     # retry the file: create new task with new FileDesc to reflect fresh scan results
-                task.KeepUntil = now + self.TaskKeepInterval
-                self.RecentTasks[name] = task
-                self.NextRetry[name] = now + self.RetryCooldown
-                self.TaskQueue.addTask(task)
-                task.timestamp("queued")
-                nqueued += 1
-        self.log("%d new files queued out of %d found by the scanner" % (nqueued, len(files_dict)))
+        ready = [(name, entry) for name, entry in self.RetryPending.items() if name not in in_progress and name not in self.NextRetry]
+        if self.Credits is not None:
+            # spend the credits on the best candidates, the rest remain pending
+            ready = heapq.nsmallest(max(0, self.Credits - len(in_progress)), ready, key=self.priority)
+        else:
+            ready.sort(key=self.priority)
+        for name, entry in ready:           # best first, the queues are FIFO
+            del self.RetryPending[name]
+            filedesc = entry.descriptor()
+            config = filedesc.Source.MoverConfig if filedesc.Source is not None else self.Config
+            task = MoverTask(config, filedesc, self.MetaCatDeclarer, self.RucioDeclarer)     # retry the file: create new task with new FileDesc to reflect fresh scan results
+            task.KeepUntil = now + self.TaskKeepInterval
+            self.RecentTasks[name] = task
+            self.NextRetry[name] = now + self.RetryCooldown
+            if self.Prefetcher is not None:
+                self.Prefetching[name] = task
+                self.Prefetcher.prefetch(task, self.prefetch_done)
+            else:
+                self.queue_task(task)
+        return len(ready)
 
     @synchronized
-    def taskEnded(self, queue, task, _):
-        if task.Failed:
-            return self.taskFailed(queue, task, None, None, None)
+    def queue_task(self, task):
+        task.timestamp("queued")            # before the task can start and update its status
+        task.Queued = time.time()
+        self.save_state(task, "queued", MoverTask.Stages[0])
+        self.StageQueues[MoverTask.Stages[0]].addTask(StageTask(task, MoverTask.Stages[0], self))
+        self.Prefetching.pop(task.FileDesc.Name, None)
+
+    def next_stage(self, task, stage):
+        # called by StageTask. Not synchronized because it may block while the next stage queue is full
+        i = MoverTask.Stages.index(stage) + 1
+        if i < len(MoverTask.Stages):
+            next_stage = MoverTask.Stages[i]
+            task.timestamp("waiting for " + next_stage)
+            self.save_state(task, "in progress", next_stage)
+            self.StageQueues[next_stage].addTask(StageTask(task, next_stage, self))
+
+    def prefetch_done(self, task, error, quarantine):
+        # called by the prefetcher, not synchronized to quarantine the file outside of the lock
+        if error is None:
+            self.prefetch_ready(task)
         else:
-            self.log("\nMover done:", task.name, "\n\n")
-            task.KeepUntil = time.time() + self.TaskKeepInterval
-            task.RetryAfter = time.time() + self.RetryCooldown
-            desc = task.FileDesc
-            self.HistoryDB.file_done(desc.Name, desc.Size, task.Started, task.Ended)
+            task.Started = task.Started or time.time()
+            try:
+                if quarantine:
+                    try:
+                        task.quarantine(error)
+                    except Exception as e:
+                        # e.g. the quarantine location is not configured
+                        task.failed(f"{error}, can not quarantine: {e}")
+                else:
+                    task.failed(error)
+            finally:
+                task.Ended = time.time()
+                self.prefetch_failed(task)
+
+    @synchronized
+    def prefetch_ready(self, task):
+        self.Prefetched.add(task.FileDesc.Name)
+        self.release_prefetched()
+
+    @synchronized
+    def release_prefetched(self):
+        # the prefetch workers finish in any order. Queue the tasks in the order they were started by start_pending(),
+        # so that the feeding order is kept: a task waits for the earlier ones to be prefetched or to fail
+        for name, task in list(self.Prefetching.items()):
+            if name not in self.Prefetched:
+                break
+            self.Prefetched.remove(name)
+            self.queue_task(task)
 
     @synchronized
-    def taskFailed(self, queue, task, exc_type, exc_value, tb):
+    def prefetch_failed(self, task):
+        self.Prefetching.pop(task.FileDesc.Name, None)
+        self.Prefetched.discard(task.FileDesc.Name)
+        self.mover_failed(task)
+        self.release_prefetched()
+
+    def record_transfer(self, stage_task, ok):
+        task = stage_task.Mover
+        if self.ConcurrencyController is not None and stage_task.Stage == "transfer" \
+                    and "transferring data" in task.EventDict:
+            # the stage task ends after the mover is handed to the next stage, which may block
+            t_end = task.EventDict.get("waiting for declare" if ok else "failed", time.time())
+            elapsed = t_end - task.EventDict["transferring data"]
+            self.ConcurrencyController.record(elapsed, task.FileSize or 0, ok)
+
+    @synchronized
+    def taskEnded(self, queue, stage_task, ok):
+        # the mover may be already in a later stage, so use the result of this stage rather than task.Failed
+        task = stage_task.Mover
+        self.record_transfer(stage_task, ok)
+        if not ok:
+            task.Ended = time.time()
+            self.mover_failed(task)
+            self.refill()
+        elif stage_task.Stage == MoverTask.Stages[-1]:
+            task.Ended = time.time()
+            self.mover_done(task)
+            self.refill()
+
+    @synchronized
+    def taskFailed(self, queue, stage_task, exc_type, exc_value, tb):
+        task = stage_task.Mover
+        self.record_transfer(stage_task, False)
+        task.Ended = time.time()
+        self.mover_failed(task, exc_type, exc_value, tb)
+        self.refill()
+
+    @synchronized
+    def refill(self):
+        # start more pending files once half of the credits are free, rather than after each finished file
+        if self.Credits is not None and self.RetryPending and self.credits() >= max(1, self.Credits // 2):
+            self.start_pending()
+
+    @synchronized
+    def mover_done(self, task):
+        self.log("\nMover done:", task.name, "\n\n")
+        task.KeepUntil = time.time() + self.TaskKeepInterval
+        task.RetryAfter = time.time() + self.RetryCooldown
+        desc = task.FileDesc
+        self.RetryPending.pop(desc.Name, None)
+        self.FirstSeen.pop(desc.Name, None)
+        if self.Prefetcher is not None:
+            self.Prefetcher.evict(desc)
+        self.HistoryDB.file_done(desc.Name, desc.Size, task.Started, task.Ended)
+        self.save_state(task, "done")
+
+    @synchronized
+    def mover_failed(self, task, exc_type=None, exc_value=None, tb=None):
         if exc_type is not None:
             error = "".join(traceback.format_exception(exc_type, exc_value, tb))
             error = "\n" + textwrap.indent(error, "    ")
@@ -689,9 +985,17 @@ class Manager(PyThread, Logged):
         self.log(f"\nMover failed: {task.name} status: {task.Status} error:", error, "\n\n")
         #self.debug("taskFailed: error:", error)
         if task.Status == "quarantined":
+            self.RetryPending.pop(desc.Name, None)
+            self.FirstSeen.pop(desc.Name, None)
+            if self.Prefetcher is not None:
+                self.Prefetcher.evict(desc)
             self.HistoryDB.file_quarantined(desc.Name, task.Started, error, task.Ended)
+            self.save_state(task, "quarantined", info=task.Error)
         else:
+            # retry after the cooldown unless the scanner reports that the file is gone
+            self.RetryPending.setdefault(desc.Name, desc)
             self.HistoryDB.file_failed(desc.Name, desc.Size, task.Started, error, task.Ended)
+            self.save_state(task, "failed", info=task.Error)
 
     @synchronized
     def purge_memory(self):
@@ -700,10 +1004,29 @@ class Manager(PyThread, Logged):
         nafter  = len(self.RecentTasks)
         self.log("purge_memory: known files before and after:", nbefore, nafter)
 
+    def warm_up_dir_cache(self):
+        dir_cache = storage.directory_cache(self.Config)
+        if dir_cache is not None and dir_cache.WarmUpDepth > 0:
+            server = self.Config.get("destination_server") or self.Config["source_server"]
+            dir_cache.warm_up(storage.backend(self.Config), server, self.Config["destination_root_path"])
+
     def run(self):
+        for declarer in (self.MetaCatDeclarer, self.RucioDeclarer):
+            if declarer is not None:
+                declarer.start()
+        PyThread(target=self.warm_up_dir_cache, name="DirCacheWarmUp", daemon=True).start()
+        if self.ConcurrencyController is not None:
+            self.ConcurrencyController.start()
         while not self.Stop:
-            self.sleep(60)
+            self.sleep(min(60, self.RetryCooldown))
+            self.start_pending()
             self.purge_memory()
         self.log("stopping ...")
-        self.TaskQueue.drain()
+        for queue in self.StageQueues.values():
+            queue.drain()
+        for declarer in (self.MetaCatDeclarer, self.RucioDeclarer):
+            if declarer is not None:
+                declarer.stop()
+        if self.ConcurrencyController is not None:
+            self.ConcurrencyController.stop()
         self.log("ending thread")
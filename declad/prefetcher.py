@@ -0,0 +1,48 @@
+from tools import FIFOTaskQueue
+from logs import Logged
+from cache import ExpiringCache
+
+class MetadataPrefetcher(Logged):
+    """
+    Loads and validates metadata of newly discovered files in a bounded pool of workers, before the
+    mover tasks are queued, so that invalid files do not take a mover slot.
+    Validated metadata is cached by (name, size) until the file is moved or quarantined.
+    """
+
+    DefaultWorkers = 5
+    DefaultCacheSize = 10000
+    DefaultCacheTTL = 3600
+
+    def __init__(self, config):
+        # config is the "prefetch" section of the declad configuration
+        Logged.__init__(self, "MetadataPrefetcher")
+        self.Queue = FIFOTaskQueue(config.get("workers", self.DefaultWorkers))
+        self.Cache = ExpiringCache(config.get("cache_size", self.DefaultCacheSize), config.get("cache_ttl", self.DefaultCacheTTL))
+
+    def key(self, desc):
+        return (desc.Name, desc.Size)
+
+    def prefetch(self, task, callback):
+        # callback(task, error, quarantine) is called when the metadata is loaded or the loading failed
+        metadata = self.Cache.get(self.key(task.FileDesc))
+        if metadata is not None:
+            task.Metadata = metadata
+            callback(task, None, False)
+        else:
+            self.Queue.append(self.load, task, callback)
+
+    def load(self, task, callback):
+        try:
+            metadata, error, quarantine = task.load_metadata()
+        except Exception as e:
+            metadata, error, quarantine = None, f"Metadata prefetch error: {e}", False
+        if metadata is not None:
+            task.Metadata = metadata
+            self.Cache.set(self.key(task.FileDesc), metadata)
+        callback(task, error, quarantine)
+
+    def evict(self, desc):
+        self.Cache.remove(self.key(desc))
+
+    def __len__(self):
+        return len(self.Queue)
@@ -1,7 +1,124 @@
 from rucio.client import Client
+from batching import Batcher
+from cache import ExpiringCache
+from client_pool import ClientPool, shared
 
 def client(config):
     if config.get("declare_to_rucio", True):
         return Client()		#account=config.get("account", "root"))
     else:
         return None
+
+def pool_size(config):
+    # number of batches declared concurrently, one client each
+    return config.get("pool_size", 5)
+
+def client_pool(config):
+    # returns the process-wide pool of Rucio clients
+    if config.get("declare_to_rucio", True):
+        return shared(("rucio",), 
+            lambda: ClientPool(lambda: client(config), pool_size(config), name="RucioClientPool"))
+    else:
+        return None
+
+class RucioDatasetError(Exception):
+    # error creating the Rucio dataset or its replication rules
+    pass
+
+class RucioDeclarer(Batcher):
+    """
+    Registers file replicas in the drop RSE and attaches the files to their Rucio datasets in batches,
+    grouped by (drop_rse, dataset_scope, dataset_name).
+
+    Datasets and replication rules known to exist are remembered in a bounded expiring cache,
+    so that add_did() and add_replication_rule() are called only once per dataset instead of once per file.
+    """
+
+    DefaultCacheSize = 10000
+    DefaultCacheTTL = 3600
+
+    def __init__(self, config):
+        # config is the "rucio" section of the declad configuration
+        Batcher.__init__(self, "RucioDeclarer",
+            max_size = config.get("batch_size"),
+            max_delay = config.get("batch_delay"),
+            workers = pool_size(config)
+        )
+        self.Config = config
+        self.DropRSE = config["drop_rse"]
+        self.TargetRSEs = config.get("target_rses", [])
+        self.Known = ExpiringCache(config.get("cache_size", self.DefaultCacheSize), config.get("cache_ttl", self.DefaultCacheTTL))
+        self.ClientPool = client_pool(config)
+
+    def declare(self, dataset_scope, dataset_name, file_scope, name, size, adler32, timeout=None):
+        item = dict(scope=file_scope, name=name, bytes=size, adler32=adler32)
+        return self.submit((self.DropRSE, dataset_scope, dataset_name), item).wait(timeout)
+
+    def ensure_dataset(self, client, scope, name):
+        from rucio.common.exception import DataIdentifierAlreadyExists, DuplicateRule
+
+        if ("dataset", scope, name) not in self.Known:
+            try:    client.add_did(scope, name, "DATASET")
+            except DataIdentifierAlreadyExists:
+                pass
+            except Exception as e:
+                raise RucioDatasetError(f"Error in creating Rucio dataset {scope}:{name}: {e}")
+            else:
+                self.log(f"Rucio dataset {scope}:{name} created")
+            self.Known.add(("dataset", scope, name))
+
+        for target_rse in self.TargetRSEs:
+            if ("rule", scope, name, target_rse) not in self.Known:
+                try:
+                    client.add_replication_rule([{"scope":scope, "name":name}], 1, target_rse)
+                except DuplicateRule:
+                    pass
+                except Exception as e:
+                    raise RucioDatasetError(f"Error in creating Rucio replication rule {scope}:{name} -> {target_rse}: {e}")
+                else:
+                    self.log(f"replication rule {scope}:{name} -> {target_rse} created")
+                self.Known.add(("rule", scope, name, target_rse))
+
+    def add_replicas(self, client, rse, files):
+        # returns [None or Exception, ...]
+        from rucio.common.exception import Duplicate
+
+        try:
+            client.add_replicas(rse, files)
+        except Exception as e:
+            if len(files) == 1:
+                if isinstance(e, Duplicate):
+                    return [None]           # already registered
+                return [e]
+            # register one by one to isolate the failing file(s)
+            self.log("bulk registration of %d replicas in %s failed: %s. Will register one by one" % (len(files), rse, e))
+            return [self.add_replicas(client, rse, [f])[0] for f in files]
+        return [None]*len(files)
+
+    def process_batch(self, key, files):
+        with self.ClientPool.client() as client:
+            return self.declare_batch(client, key, files)
+
+    def declare_batch(self, client, key, files):
+        drop_rse, dataset_scope, dataset_name = key
+        try:
+            self.ensure_dataset(client, dataset_scope, dataset_name)
+        except RucioDatasetError as e:
+            # the dataset may have been removed, do not trust the cache next time
+            self.Known.remove(("dataset", dataset_scope, dataset_name))
+            return [e]*len(files)
+
+        results = self.add_replicas(client, drop_rse, files)
+        registered = [f for f, r in zip(files, results) if r is None]
+        if registered:
+            try:
+                client.attach_dids_to_dids([{
+                        "scope":    dataset_scope,
+                        "name":     dataset_name,
+                        "dids":     [{"scope":f["scope"], "name":f["name"]} for f in registered]
+                    }], ignore_duplicate=True)
+            except Exception as e:
+                results = [e if r is None else r for r in results]
+        self.log("batch for %s:%s: %d files, %d registered and attached" % (
+            dataset_scope, dataset_name, len(files), len([r for r in results if r is None])))
+        return results
@@ -1,5 +1,7 @@
 from logs import Logged
+from client_pool import shared
 import requests, json
+from requests.adapters import HTTPAdapter
 from urllib.parse import quote, urlencode
 
 class SAMDeclarationError(Exception):
@@ -15,18 +17,26 @@ class SAMDeclarationError(Exception):
 
 class SAMWebClient(Logged):
     
-    def __init__(self, url, cert, key):
+    DefaultPoolSize = 10
+
+    def __init__(self, url, cert, key, pool_size=None):
         Logged.__init__(self)
         self.URL = url
         self.Cert = cert
         self.Key = key
+        # keep-alive HTTP(S) connections shared by all threads using the client
+        pool_size = pool_size or self.DefaultPoolSize
+        self.Session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.Session.mount("https://", adapter)
+        self.Session.mount("http://", adapter)
 
     def get_file(self, name=None, id=None):
         if name:
             url = self.URL + "/files/name/" + quote(name) + "/metadata?format=json"
         else:
             url = self.URL + f"/files/id/{id}/metadata?format=json"
-        response = requests.get(url, headers={"Accept":"application/json"})
+        response = self.Session.get(url, headers={"Accept":"application/json"})
         if response.status_code // 100 == 2:
             return response.json()
         else:
@@ -35,7 +45,7 @@ class SAMWebClient(Logged):
     def declare(self, metadata, location=None):
         data = json.dumps(metadata, indent=1, sort_keys=True)
         file_name = metadata["file_name"]
-        response = requests.post(self.URL + "/files", data=data,
+        response = self.Session.post(self.URL + "/files", data=data,
                         headers={"Content-Type":"application/json"},
 			cert=(self.Cert, self.Key)
         )
@@ -68,7 +78,7 @@ class SAMWebClient(Logged):
         #self.debug("  url:", url)
         #self.debug("  headers:", headers)
         #self.debug("  data:", data)
-        response = requests.post(url, data=data, headers=headers,
+        response = self.Session.post(url, data=data, headers=headers,
             cert=(self.Cert, self.Key)
         )
         #self.debug("response:", str(response))
@@ -82,7 +92,7 @@ class SAMWebClient(Logged):
             url = self.URL + "/files/name/" + quote(name) + "/locations"
         else:
             url = self.URL + f"/files/id/{id}/locations"
-        response = requests.get(url,
+        response = self.Session.get(url,
             headers={
                 "Accept" : "application/json",
                 "SAM-Role": "default"
@@ -101,12 +111,15 @@ class SAMWebClient(Logged):
     def files_exist(self, names):
         url = self.URL + "/files/metadata"
         params = {"file_name": list(names)}
-        response = requests.post(url, data=json.dumps(params))
+        response = self.Session.post(url, data=json.dumps(params))
         return set(f["file_name"] for f in response.json())
 
 def client(config):
+    # returns the process-wide client for the URL and credentials
     if "url" in config:
-        return SAMWebClient(config["url"], config.get("cert"), config.get("key"))
+        url, cert, key = config["url"], config.get("cert"), config.get("key")
+        return shared(("samweb", url, cert, key), 
+            lambda: SAMWebClient(url, cert, key, pool_size=config.get("pool_size")))
     else:
         return None
 
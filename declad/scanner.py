@@ -1,75 +1,242 @@
 from pythreader import PyThread, synchronized, Primitive
-from tools import runCommand
+from tools import runCommand, FIFOTaskQueue
 import time, fnmatch, traceback
 from logs import Logged
-from xrootd_scanner import XRootDScanner
+from snapshot import ScanSnapshot
+from file_descriptor import FileDescriptor
+from listing import FileListing
+import storage
+
+
+class ScanSource(Logged):
+    #
+    # One input location scanned by the scanner: the location, the filename patterns, the snapshot of the previous
+    # scans and the status of the last scan, shown by the web GUI
+    #
+    # source_config is a scanner.sources item or, if the sources are not configured, the scanner section itself
+    #
+
+    def __init__(self, config, source_config, multi=False, history_db=None):
+        scan_config = config["scanner"]
+        self.Server = source_config.get("server")
+        self.Location = source_config["location"]
+        self.Name = source_config.get("name") or (f"{self.Server}:{self.Location}" if self.Server else self.Location)
+        Logged.__init__(self, f"ScanSource[{self.Name}]")
+        patterns = source_config.get("filename_patterns") or source_config.get("filename_pattern") \
+            or scan_config.get("filename_patterns") or scan_config.get("filename_pattern")
+        if not patterns:
+            raise ValueError(f"Filename patterns (filename_patterns) not found in the config file for {self.Name}")
+        self.FilenamePatterns = patterns if isinstance(patterns, list) else [patterns]
+        self.MetaSuffix = config.get("meta_suffix", ".json")
+        self.MetadataPatterns = [pattern + self.MetaSuffix for pattern in self.FilenamePatterns]
+        self.Snapshot = ScanSnapshot(source_config.get("stable_scans", scan_config.get("stable_scans")),
+            source_config.get("incremental", scan_config.get("incremental", True)))
+
+        # configuration for the movers of the files found in this source
+        if multi:
+            self.MoverConfig = dict(config,
+                source_server = source_config.get("source_server", self.Server),
+                source_root_path = source_config.get("source_root_path", self.Location),
+                quarantine_location = source_config.get("quarantine_location", config.get("quarantine_location"))
+            )
+        else:
+            self.MoverConfig = config
+
+        # last scan status
+        self.Scanning = False
+        self.LastStarted = self.LastEnded = None
+        self.NScans = self.NErrors = 0
+        self.NFound = self.NSent = self.NRemoved = 0
+        self.Error = self.ErrorTime = None
+        self.LastMetrics = {}
+        self.HistoryDB = history_db         # scan metrics are recorded in the scanner_log table, if not None
+
+    def quarantine_location(self):
+        return self.MoverConfig.get("source_server"), self.MoverConfig.get("quarantine_location")
+
+    def matches(self, desc):
+        return any(fnmatch.fnmatch(desc.Name, pattern) for pattern in self.FilenamePatterns + self.MetadataPatterns)
+
+    def data_name(self, name):
+        # returns the data file name for a data or metadata file name, or None if the name does not match the patterns
+        if any(fnmatch.fnmatch(name, pattern) for pattern in self.FilenamePatterns):
+            return name
+        if any(fnmatch.fnmatch(name, pattern) for pattern in self.MetadataPatterns):
+            return name[:-len(self.MetaSuffix)]
+        return None
+
+    def pair_files(self, files):
+        #
+        # files: iterable of FileDescriptors and, possibly, directory paths, may be a generator reading the listing
+        # returns FileListing of the data files with metadata, with the metadata file sizes
+        #
+        data_files = {}         # name -> (relpath, size), waiting for the metadata file
+        metadata_files = {}     # data file name correspoinding to the metadata name -> metadata file size
+        listing = None
+        nfiles = 0
+
+        for desc in files:
+            if not isinstance(desc, FileDescriptor):
+                continue            # directory
+            nfiles += 1
+            if listing is None:
+                listing = FileListing(desc.Server, desc.Location, self)
+            if any(fnmatch.fnmatch(desc.Name, pattern) for pattern in self.FilenamePatterns):
+                if desc.Name in metadata_files:
+                    listing.append(desc.RelPath, desc.Size, metadata_files.pop(desc.Name))
+                else:
+                    data_files[desc.Name] = (desc.RelPath, desc.Size)
+            elif any(fnmatch.fnmatch(desc.Name, pattern) for pattern in self.MetadataPatterns) and desc.Size > 0:
+                data_name = desc.Name[:-len(self.MetaSuffix)]
+                data_file = data_files.pop(data_name, None)
+                if data_file is not None:
+                    relpath, size = data_file
+                    listing.append(relpath, size, desc.Size)
+                else:
+                    metadata_files[data_name] = desc.Size
+        self.debug("scanner returned %d file descriptors" % (nfiles,))
+        return listing if listing is not None else FileListing(self.Server, self.Location, self)
+
+    def timed_listing(self, files, metrics):
+        # passes the listing through, accumulating the time spent waiting for it and the number of entries
+        files = iter(files)
+        while True:
+            t0 = time.time()
+            try:
+                item = next(files)
+            except StopIteration:
+                metrics["list_time"] += time.time() - t0
+                return
+            metrics["list_time"] += time.time() - t0
+            metrics["nentries"] += 1
+            yield item
+
+    def scan(self, files, receiver):
+        # files: iterable of FileDescriptors returned by the listing
+        # sends new and changed files and the names of removed files to the receiver
+        self.scan_started()
+        metrics = dict(list_time=0.0, nentries=0)
+        try:
+            listing = self.pair_files(self.timed_listing(files, metrics))
+        except:
+            # do not take the failed listing as if all the files were removed
+            self.scan_ended(metrics, error="".join(traceback.format_exc()))
+            return
+        metrics["pair_time"] = time.time() - self.LastStarted - metrics["list_time"]
+        nfound = len(listing)
+        nbytes = sum(listing.Sizes)
+        self.log("found %d matching files" % (nfound,))
+        listing, removed = self.Snapshot.update(listing)
+        self.log("%d files to send, %d removed, %d not stable yet" % (len(listing), len(removed), self.Snapshot.unstable()))
+        if removed:
+            receiver.remove_files(removed)
+        if len(listing):
+            receiver.add_files(listing)
+        npending, ncooldown = receiver.pending_counts()
+        metrics.update(nfound=nfound, nbytes=nbytes, nsent=len(listing), nbytes_sent=sum(listing.Sizes),
+            nremoved=len(removed), nunstable=self.Snapshot.unstable(), npending=npending, ncooldown=ncooldown)
+        self.scan_ended(metrics)
+
+    def scan_started(self):
+        self.Scanning = True
+        self.LastStarted = time.time()
+
+    def scan_ended(self, metrics=None, error=None):
+        # metrics: dict with the scanner_log columns measured so far
+        self.Scanning = False
+        self.LastEnded = time.time()
+        self.NScans += 1
+        metrics = metrics or {}
+        if error:
+            self.error("scanner error:", error)
+            self.NErrors += 1
+            self.Error, self.ErrorTime = error, self.LastEnded
+        else:
+            self.NFound, self.NSent, self.NRemoved = metrics.get("nfound", 0), metrics.get("nsent", 0), metrics.get("nremoved", 0)
+            self.Error = self.ErrorTime = None
+        self.LastMetrics = metrics
+        if self.HistoryDB is not None:
+            try:
+                self.HistoryDB.add_scanner_record(self.Name, self.Server, self.Location,
+                    self.LastStarted or self.LastEnded, self.duration(), error=error, **metrics)
+            except:
+                self.error("can not record the scan in the history DB:", "".join(traceback.format_exc()))
+
+    def duration(self):
+        if self.LastStarted is not None and self.LastEnded is not None and self.LastEnded >= self.LastStarted:
+            return self.LastEnded - self.LastStarted
+        return None
+
+    def unstable(self):
+        return self.Snapshot.unstable()
 
 
 class Scanner(PyThread, Logged):
+    #
+    # Scans the configured sources concurrently, using a bounded pool of workers and staggering the scans,
+    # and sends the results to the same receiver
+    #
 
     MetaSuffix = ".json"
     DefaultInterval = 300
+    DefaultWorkers = 4
+    DefaultStagger = 5.0
 
-    def __init__(self, receiver, config):
+    def __init__(self, receiver, config, history_db=None):
         PyThread.__init__(self, daemon=True, name="Scanner")
         Logged.__init__(self, f"Scanner")
         self.Receiver = receiver
         scan_config = config["scanner"]
         self.Interval = scan_config.get("interval", self.DefaultInterval)
-        self.Server, self.Location = scan_config["server"], scan_config["location"]
-        self.XScanner = XRootDScanner(self.Server, scan_config)
-        patterns = scan_config.get("filename_patterns") or scan_config.get("filename_pattern")
-        if not patterns:
-            raise ValueError("Filename patterns (filename_patterns) not found in the config file")
-        self.FilenamePatterns = patterns if isinstance(patterns, list) else [patterns]
-        self.MetaSuffix = config.get("meta_suffix", ".json")
-        self.MetadataPatterns = [pattern + self.MetaSuffix for pattern in self.FilenamePatterns]
+        self.Storage = storage.backend(config)
+        sources = scan_config.get("sources")
+        if sources:
+            self.Sources = [ScanSource(config, source_config, multi=True, history_db=history_db) for source_config in sources]
+        else:
+            self.Sources = [ScanSource(config, scan_config, history_db=history_db)]
+        names = [source.Name for source in self.Sources]
+        if len(set(names)) != len(names):
+            raise ValueError("Scanner source names must be unique")
+        self.Server, self.Location = self.Sources[0].Server, self.Sources[0].Location
+        # by default, spread the scans over the interval, but not wider than DefaultStagger
+        stagger = scan_config.get("stagger", min(self.DefaultStagger, self.Interval/len(self.Sources)))
+        self.ScanQueue = FIFOTaskQueue(scan_config.get("workers", self.DefaultWorkers),
+                stagger=stagger if len(self.Sources) > 1 else 0.0, name="scan_queue")
         self.Stop = False
 
     def ls_input(self):
-            try: files = self.XScanner.scan(self.Location)
+        out = []
+        errors = []
+        for source in self.Sources:
+            try: files, _ = self.Storage.ls(source.Server, source.Location)
             except:
-                return None, "xrootd scanner error: " + "".join(traceback.format_exc())
+                errors.append(f"{source.Name}: scanner error: " + "".join(traceback.format_exc()))
+            else:
+                out += [desc for desc in files if source.matches(desc)]
+        return out, "\n".join(errors) or None
+
+    def quarantine_locations(self):
+        return sorted(set(source.quarantine_location() for source in self.Sources))
 
-            return [
-                desc for desc in files
-                if any(fnmatch.fnmatch(desc.Name, pattern) for pattern in self.FilenamePatterns + self.MetadataPatterns) 
-            ], None
+    def scan(self, source):
+        try:
+            files = self.Storage.iter_files(source.Server, source.Location)
+        except:
+            source.scan_started()
+            source.scan_ended(error="".join(traceback.format_exc()))
+        else:
+            source.scan(files, self.Receiver)
+
+    def stop(self):
+        self.Stop = True
+        self.wakeup()
 
-        
     def run(self):
         while not self.Stop:
-            data_files = {}         # name -> desc
-            metadata_files = set()  # data file names correspoinding to the metadata names
-            try: files = self.XScanner.scan(self.Location)
-            except:
-                self.error("xrootd scanner error:", "".join(traceback.format_exc()))
-            self.debug("scanner returned %d file descriptors" % (len(files,)))
-
-            out_files = {}
-
-            for desc in files:
-                if any(fnmatch.fnmatch(desc.Name, pattern) for pattern in self.FilenamePatterns):
-                    meta_name = desc.Name + self.MetaSuffix
-                    if desc.Name in metadata_files:
-                        out_files[desc.Name] = desc
-                    else:
-                        data_files[desc.Name] = desc
-                elif any(fnmatch.fnmatch(desc.Name, pattern) for pattern in self.MetadataPatterns) and desc.Size > 0:
-                    data_name = desc.Name[:-len(self.MetaSuffix)]
-                    data_desc = data_files.get(data_name)
-                    if data_desc is not None:
-                        out_files[data_name] = data_desc
-                    else:
-                        metadata_files.add(data_name)
-
-            self.log("found %d matching files" % (len(out_files),))
-            
-            if out_files:
-                #self.debug("sending files:")
-                #for fn, desc in out_files.items():
-                #    self.debug(desc.Path, fn)
-                self.Receiver.add_files(out_files)
-
+            # sources still being scanned since the previous interval are skipped
+            for source in self.Sources:
+                if not source.Scanning:
+                    source.Scanning = True
+                    self.ScanQueue.append(self.scan, source)
             if not self.Stop:
                 self.sleep(self.Interval)
@@ -0,0 +1,189 @@
+from array import array
+from bisect import bisect_left
+from itertools import accumulate
+from pythreader import Primitive, synchronized
+
+class SnapshotColumns(object):
+    #
+    # State of the files found by a scan, sorted by the name hash: the UTF-8 names in one buffer and
+    # the sizes, counts and reported sizes in arrays
+    #
+
+    def __init__(self):
+        self.Keys = array("q")              # hash of the name, sorted
+        self.Names = bytearray()            # names, concatenated in the order of the keys
+        self.Offsets = array("Q", [0])      # name k is Names[Offsets[k]:Offsets[k+1]]
+        self.Sizes = array("q")             # last seen data and metadata sizes
+        self.MetaSizes = array("q")
+        self.Counts = array("l")            # number of consecutive scans with these sizes
+        self.ReportedSizes = array("q")     # sizes the file was reported with, -1 if not reported
+        self.ReportedMetaSizes = array("q")
+
+    def __len__(self):
+        return len(self.Keys)
+
+    def name(self, k):
+        return bytes(self.Names[self.Offsets[k]:self.Offsets[k+1]])
+
+    def find(self, name):
+        # name: bytes, returns the index or -1
+        key = hash(name)
+        k = bisect_left(self.Keys, key)
+        while k < len(self.Keys) and self.Keys[k] == key:
+            if self.name(k) == name:
+                return k
+            k += 1
+        return -1
+
+    def state(self, k):
+        # returns (sizes, count, reported sizes or None)
+        reported = None
+        if self.ReportedSizes[k] >= 0:
+            reported = (self.ReportedSizes[k], self.ReportedMetaSizes[k])
+        return (self.Sizes[k], self.MetaSizes[k]), self.Counts[k], reported
+
+    def is_reported(self, k):
+        return self.ReportedSizes[k] >= 0
+
+    def nbytes(self):
+        # approximate memory used by the columns
+        return len(self.Names) + sum(a.itemsize * len(a) for a in (self.Keys, self.Offsets, self.Sizes, self.MetaSizes,
+            self.Counts, self.ReportedSizes, self.ReportedMetaSizes))
+
+
+class ScanSnapshot(Primitive):
+    """
+    Remembers the files found by the previous scans and reports only the changes, so that the receiver
+    does not have to process the whole listing every time.
+
+    A file is reported as new only after its data and metadata sizes have stayed the same for StableScans
+    consecutive scans, so that files still being written are not picked up. A file is reported again if its size
+    changes. Files which disappeared from the listing are reported as removed.
+
+    If incremental is False, all stable files are reported after each scan, not only new and changed ones.
+
+    The state is kept in SnapshotColumns, merged with each new listing in the order of the name hash.
+    Files reported or forgotten between the scans, e.g. on file system events, are kept in a dict until
+    the next scan.
+
+    The scanner and the file system event threads change the snapshot and the web server reads it, so the methods
+    are synchronized. unstable() counts from a copy of the state taken under the lock.
+    """
+
+    DefaultStableScans = 2
+
+    def __init__(self, stable_scans=None, incremental=True):
+        Primitive.__init__(self, name="ScanSnapshot")
+        self.StableScans = max(1, stable_scans or self.DefaultStableScans)
+        self.Incremental = incremental
+        self.Files = SnapshotColumns()
+        self.Events = {}            # name bytes -> sizes reported, or None if forgotten, since the last scan
+
+    @synchronized
+    def update(self, listing):
+        # listing: FileListing of the data files paired with their metadata files found by the scan
+        # returns (FileListing - new or changed stable files, [name, ...] - removed files)
+        old, events = self.Files, self.Events
+        names = listing.names_bytes()
+        keys = array("q", map(hash, names))
+        order = sorted(range(len(listing)), key=keys.__getitem__)
+
+        # merge the listing, in the order of the keys, with the old state
+        old_keys, old_names, old_offsets = old.Keys, old.Names, old.Offsets
+        old_sizes, old_meta_sizes, old_counts = old.Sizes, old.MetaSizes, old.Counts
+        old_reported_sizes, old_reported_meta_sizes = old.ReportedSizes, old.ReportedMetaSizes
+        stable_scans, incremental = self.StableScans, self.Incremental
+        nold = len(old)
+        matched = bytearray(nold)           # 1 if the file is still in the listing
+        listed_events = set()
+        sizes, meta_sizes = listing.Sizes, listing.MetaSizes
+        counts, reported_sizes, reported_meta_sizes = array("l"), array("q"), array("q")
+        selected = []
+        j = 0
+        for i in order:
+            key, name, size, meta_size = keys[i], names[i], sizes[i], meta_sizes[i]
+            while j < nold and old_keys[j] < key:
+                j += 1
+            count, rsize, rmeta_size = 0, -1, -1
+            k = j
+            while k < nold and old_keys[k] == key:
+                if not matched[k] and old_names[old_offsets[k]:old_offsets[k+1]] == name:
+                    matched[k] = 1
+                    if old_sizes[k] == size and old_meta_sizes[k] == meta_size:
+                        count = old_counts[k]
+                    rsize, rmeta_size = old_reported_sizes[k], old_reported_meta_sizes[k]
+                    break
+                k += 1
+            if events and name in events:
+                listed_events.add(name)
+                reported = events[name]
+                if reported is None:
+                    count, rsize, rmeta_size = 0, -1, -1
+                else:
+                    rsize, rmeta_size = reported
+                    count = stable_scans if reported == (size, meta_size) else 0
+            count += 1
+            if count >= stable_scans and (not incremental or rsize != size or rmeta_size != meta_size):
+                selected.append(i)
+                rsize, rmeta_size = size, meta_size
+            counts.append(count)
+            reported_sizes.append(rsize)
+            reported_meta_sizes.append(rmeta_size)
+
+        removed = []
+        k = matched.find(0)
+        while k >= 0:
+            if old.is_reported(k):
+                name = old.name(k)
+                if name not in events:
+                    removed.append(name.decode("utf-8"))
+            k = matched.find(0, k + 1)
+        removed += [name.decode("utf-8") for name, sizes in events.items() if sizes is not None and name not in listed_events]
+
+        files = self.Files = SnapshotColumns()
+        files.Keys = array("q", map(keys.__getitem__, order))
+        names = [names[i] for i in order]
+        files.Names = bytearray(b"".join(names))
+        files.Offsets.extend(accumulate(map(len, names)))
+        files.Sizes = array("q", map(sizes.__getitem__, order))
+        files.MetaSizes = array("q", map(meta_sizes.__getitem__, order))
+        files.Counts, files.ReportedSizes, files.ReportedMetaSizes = counts, reported_sizes, reported_meta_sizes
+        self.Events = {}
+        return listing.subset(sorted(selected)), removed
+
+    @synchronized
+    def report(self, name, sizes):
+        # the file was sent to the receiver outside of the scan, e.g. on a file system event
+        self.Events[name.encode("utf-8")] = sizes
+
+    @synchronized
+    def reported(self, name):
+        # returns the sizes the file was last reported with, or None
+        name = name.encode("utf-8")
+        if name in self.Events:
+            return self.Events[name]
+        k = self.Files.find(name)
+        return self.Files.state(k)[2] if k >= 0 else None
+
+    @synchronized
+    def forget(self, name):
+        # the file disappeared. returns True if it was reported before
+        was_reported = self.reported(name) is not None
+        self.Events[name.encode("utf-8")] = None
+        return was_reported
+
+    @synchronized
+    def state(self):
+        # returns (SnapshotColumns, [name, ...] - names reported or forgotten since the last scan).
+        # update() replaces the columns instead of changing them, so they can be read without the lock
+        return self.Files, list(self.Events)
+
+    def unstable(self):
+        # number of files waiting for their sizes to stabilize
+        files, events = self.state()
+        n = files.ReportedSizes.count(-1)
+        for name in events:
+            k = files.find(name)
+            if k >= 0 and not files.is_reported(k):
+                n -= 1              # reported or forgotten since the last scan
+        return n
@@ -0,0 +1,562 @@
+import os, sys, re, zlib, json
+from pythreader import Primitive, synchronized, Promise
+from logs import Logged
+from tools import runCommand, readCommandOutput, CommandError
+from file_descriptor import FileDescriptor
+from xrootd_scanner import XRootDScanner, ScannerError
+from client_pool import shared
+from cache import ExpiringCache
+
+class StorageError(Exception):
+    pass
+
+class StorageBackend(Logged):
+    """
+    Abstract storage interface used by the scanner and the movers. Paths are absolute paths in the
+    storage namespace, the server is the storage endpoint ("host:port" for xrootd).
+    """
+
+    ConfigKeys = ["transfer_timeout", "scanner"]        # top level configuration items the backend uses
+
+    def __init__(self, config, name=None):
+        Logged.__init__(self, name or self.__class__.__name__)
+        self.Config = config
+        self.Timeout = config.get("transfer_timeout", 120)
+        self.ListTimeout = config.get("scanner", {}).get("timeout", 30)
+
+    def ls(self, server, location, timeout=None, listing_config=None):
+        # returns ([FileDescriptor, ...], [dir_path, ...]) for the location
+        # timeout: default scanner.timeout
+        # listing_config: ls_command_template and parse_re for the command backend, default: the scanner section
+        raise NotImplementedError()
+
+    def iter_files(self, server, location):
+        # yields FileDescriptor for each file in the location. Backends which can read the listing incrementally
+        # override this to avoid keeping the whole listing in memory
+        files, _ = self.ls(server, location)
+        yield from files
+
+    def stat(self, server, path):
+        # returns file size or None if the file does not exist
+        raise NotImplementedError()
+
+    def mkdir(self, server, path):
+        # creates the directory and its parents if needed
+        raise NotImplementedError()
+
+    def copy(self, src_server, src_path, dst_server, dst_path, dst_rel_path=None):
+        # returns adler32 checksum of the destination file as hex string if the backend computes it while copying, or None
+        raise NotImplementedError()
+
+    def checksum(self, server, path):
+        # returns adler32 checksum of the file as hex string or None if the storage can not provide it
+        return None
+
+    def remove(self, server, path):
+        raise NotImplementedError()
+
+    def rename(self, server, src_path, dst_path):
+        raise NotImplementedError()
+
+    def read(self, server, path, max_size=None):
+        # returns file contents as bytes. Raises StorageError if the file is larger than max_size
+        raise NotImplementedError()
+
+    @staticmethod
+    def same_checksum(a, b):
+        # adler32 values may come with or without leading zeros
+        try:
+            return int(a, 16) == int(b, 16)
+        except (ValueError, TypeError):
+            return False
+
+    @staticmethod
+    def url(server, path):
+        # EOS expects URL to have double slashes: root://host:port//path/to/file
+        return "root://" + server + "/" + path
+
+class CommandStorage(StorageBackend):
+    """
+    Runs the commands configured with the *_command_template parameters, e.g. xrdfs and xrdcp
+    """
+
+    DefaultStatCommandTemplate = "xrdfs $server stat $path"
+    DefaultRenameCommandTemplate = "xrdfs $server mv $src_path $dst_path"
+    DefaultReadCommandTemplate = "xrdcp --silent root://$server/$path -"        # file contents to stdout
+    DefaultChecksumCommandTemplate = "xrdfs $server query checksum $path"
+    ChecksumRE = re.compile(r"adler32:?\s+([0-9a-fA-F]{1,8})\b")                # "adler32 <hex>" or xrdcp --cksum adler32:print output
+
+    ConfigKeys = StorageBackend.ConfigKeys + ["stat_command_template", "create_dirs_command_template",
+        "copy_command_template", "delete_command_template", "rename_command_template", "read_command_template",
+        "download_command_template", "checksum_command_template"]
+
+    def __init__(self, config):
+        StorageBackend.__init__(self, config)
+        self.ScannerConfig = config.get("scanner", {})
+        self.StatCommandTemplate = config.get("stat_command_template", self.DefaultStatCommandTemplate)
+        self.CreateDirsCommandTemplate = config.get("create_dirs_command_template")
+        self.CopyCommandTemplate = config.get("copy_command_template")
+        self.DeleteCommandTemplate = config.get("delete_command_template")
+        self.RenameCommandTemplate = config.get("rename_command_template", self.DefaultRenameCommandTemplate)
+        self.ReadCommandTemplate = config.get("read_command_template", self.DefaultReadCommandTemplate)
+        if "download_command_template" in config:
+            # metadata files are read into memory now
+            self.error("download_command_template is obsolete and ignored. Use read_command_template, which must write "
+                "the file contents to stdout. Using:", self.ReadCommandTemplate)
+        self.ChecksumCommandTemplate = config.get("checksum_command_template", self.DefaultChecksumCommandTemplate)
+
+    def run(self, command, timeout=None):
+        ret, output = runCommand(command, timeout or self.Timeout, self.debug)
+        if ret:
+            raise StorageError(f"Command {command} failed with status {ret}: {output}")
+        return output
+
+    def ls(self, server, location, timeout=None, listing_config=None):
+        scanner = XRootDScanner(server, listing_config or self.ScannerConfig)
+        status, error, files, dirs = scanner.listFilesAndDirs(location, timeout or self.ListTimeout)
+        if status:
+            raise StorageError("Error listing %s: status=%s error=%s" % (location, status, error))
+        return files, dirs
+
+    def iter_files(self, server, location):
+        scanner = XRootDScanner(server, self.ScannerConfig)
+        try:
+            for item in scanner.iterFilesAndDirs(location, self.ListTimeout):
+                if isinstance(item, FileDescriptor):
+                    yield item
+        except (CommandError, ScannerError) as e:
+            raise StorageError(f"Error listing {location}: {e}")
+
+    def stat(self, server, path):
+        command = self.StatCommandTemplate  \
+            .replace("$server", server)     \
+            .replace("$path", path)
+        ret, out = runCommand(command, self.Timeout, self.debug)
+        for l in out.split("\n"):
+            l = l.strip()
+            if l:
+                words = l.split()
+                if len(words) == 2 and words[0] == "Size:":
+                    return int(words[1])
+                elif "no such file or directory" in l.lower():
+                    return None
+        if ret:
+            raise StorageError(f"Command {command} failed with status {ret}: {out}")
+        return None
+
+    def mkdir(self, server, path):
+        self.run(self.CreateDirsCommandTemplate     \
+            .replace("$server", server)             \
+            .replace("$path", path)
+        )
+
+    def copy(self, src_server, src_path, dst_server, dst_path, dst_rel_path=None):
+        command = self.CopyCommandTemplate      \
+            .replace("$dst_url", self.url(dst_server, dst_path))  \
+            .replace("$src_url", self.url(src_server, src_path))  \
+            .replace("$dst_data_path", dst_path)   \
+            .replace("$src_data_path", src_path)   \
+            .replace("$dst_rel_path", dst_rel_path or "")
+        output = self.run(command)
+        return self.parse_checksum(output)
+
+    def parse_checksum(self, output):
+        m = self.ChecksumRE.search(output or "")
+        return m[1].lower() if m else None
+
+    def checksum(self, server, path):
+        if not self.ChecksumCommandTemplate:
+            return None
+        output = self.run(self.ChecksumCommandTemplate  \
+            .replace("$server", server)                 \
+            .replace("$path", path)
+        )
+        checksum = self.parse_checksum(output)
+        if checksum is None:
+            raise StorageError(f"Can not parse checksum for {path} in: {output}")
+        return checksum
+
+    def remove(self, server, path):
+        self.run(self.DeleteCommandTemplate     \
+            .replace("$server", server)         \
+            .replace("$path", path)
+        )
+
+    def rename(self, server, src_path, dst_path):
+        self.run(self.RenameCommandTemplate     \
+            .replace("$server", server)         \
+            .replace("$src_path", src_path)     \
+            .replace("$dst_path", dst_path)
+        )
+
+    def read(self, server, path, max_size=None):
+        command = self.ReadCommandTemplate  \
+            .replace("$server", server)     \
+            .replace("$path", path)
+        ret, out, err = readCommandOutput(command, max_size, self.Timeout, self.debug)
+        if ret:
+            raise StorageError(f"Command {command} failed with status {ret}: {err}")
+        return out
+
+class XRootDStorage(StorageBackend):
+    """
+    Uses XRootD Python bindings in-process, without spawning xrdfs/xrdcp
+    """
+
+    NotFoundErrno = 3011            # kXR_NotFound
+
+    ConfigKeys = StorageBackend.ConfigKeys + ["storage"]
+
+    def __init__(self, config):
+        StorageBackend.__init__(self, config)
+        from XRootD import client
+        self.XRDClient = client
+        self.ThirdParty = config.get("storage", {}).get("tpc", "first")
+        self.FileSystems = {}           # server -> client.FileSystem
+
+    def fs(self, server):
+        fs = self.FileSystems.get(server)
+        if fs is None:
+            fs = self.FileSystems[server] = self.XRDClient.FileSystem("root://" + server)
+        return fs
+
+    def check(self, status, operation):
+        if not status.ok:
+            raise StorageError(f"{operation} failed: {status.message}")
+
+    def is_not_found(self, status):
+        return status.errno == self.NotFoundErrno or "no such file" in (status.message or "").lower()
+
+    def ls(self, server, location, timeout=None, listing_config=None):
+        from XRootD.client.flags import DirListFlags, StatInfoFlags
+        status, listing = self.fs(server).dirlist(location, DirListFlags.STAT, timeout=timeout or self.ListTimeout)
+        self.check(status, f"dirlist {location}")
+        files, dirs = [], []
+        for entry in listing:
+            path = location + "/" + entry.name
+            if entry.statinfo.flags & StatInfoFlags.IS_DIR:
+                dirs.append(path)
+            else:
+                files.append(FileDescriptor(server, location, path, entry.statinfo.size))
+        return files, dirs
+
+    def stat(self, server, path):
+        status, info = self.fs(server).stat(path, timeout=self.Timeout)
+        if not status.ok:
+            if self.is_not_found(status):
+                return None
+            self.check(status, f"stat {path}")
+        return info.size
+
+    def mkdir(self, server, path):
+        from XRootD.client.flags import MkDirFlags
+        status, _ = self.fs(server).mkdir(path, MkDirFlags.MAKEPATH, timeout=self.Timeout)
+        self.check(status, f"mkdir {path}")
+
+    def copy(self, src_server, src_path, dst_server, dst_path, dst_rel_path=None):
+        process = self.XRDClient.CopyProcess()
+        process.add_job(self.url(src_server, src_path), self.url(dst_server, dst_path),
+            force=True, thirdparty=self.ThirdParty, tpctimeout=self.Timeout)
+        process.prepare()
+        status, results = process.run()
+        self.check(status, f"copy {src_path} -> {dst_path}")
+        for result in results:
+            self.check(result["status"], f"copy {src_path} -> {dst_path}")
+        return None
+
+    def checksum(self, server, path):
+        from XRootD.client.flags import QueryCode
+        status, response = self.fs(server).query(QueryCode.CHECKSUM, path, timeout=self.Timeout)
+        self.check(status, f"checksum {path}")
+        words = response.decode("utf-8", "replace").strip("\x00 \n").split()
+        if len(words) != 2 or words[0].lower() != "adler32":
+            raise StorageError(f"Unexpected checksum response for {path}: {response}")
+        return words[1].lower()
+
+    def remove(self, server, path):
+        status, _ = self.fs(server).rm(path, timeout=self.Timeout)
+        self.check(status, f"rm {path}")
+
+    def rename(self, server, src_path, dst_path):
+        status, _ = self.fs(server).mv(src_path, dst_path, timeout=self.Timeout)
+        self.check(status, f"mv {src_path} {dst_path}")
+
+    def read(self, server, path, max_size=None):
+        with self.XRDClient.File() as f:
+            status, _ = f.open(self.url(server, path), timeout=self.Timeout)
+            self.check(status, f"open {path}")
+            status, info = f.stat(timeout=self.Timeout)
+            self.check(status, f"stat {path}")
+            if max_size is not None and info.size > max_size:
+                raise StorageError(f"{path} size {info.size} exceeds {max_size} bytes")
+            status, data = f.read(0, info.size, timeout=self.Timeout)
+            self.check(status, f"read {path}")
+        return data
+
+class LocalStorage(StorageBackend):
+    """
+    Local POSIX file system. The server is ignored.
+    """
+
+    def ls(self, server, location, timeout=None, listing_config=None):
+        files, dirs = [], []
+        try:
+            with os.scandir(location) as entries:
+                for entry in entries:
+                    path = location + "/" + entry.name
+                    if entry.is_dir():
+                        dirs.append(path)
+                    elif entry.is_file():
+                        files.append(FileDescriptor(server, location, path, entry.stat().st_size))
+        except OSError as e:
+            raise StorageError(f"Error listing {location}: {e}")
+        return files, dirs
+
+    def iter_files(self, server, location):
+        try:
+            with os.scandir(location) as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        yield FileDescriptor(server, location, location + "/" + entry.name, entry.stat().st_size)
+        except OSError as e:
+            raise StorageError(f"Error listing {location}: {e}")
+
+    def stat(self, server, path):
+        try:
+            return os.stat(path).st_size
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            raise StorageError(f"stat {path} failed: {e}")
+
+    def mkdir(self, server, path):
+        try:
+            os.makedirs(path, exist_ok=True)
+        except OSError as e:
+            raise StorageError(f"mkdir {path} failed: {e}")
+
+    BufferSize = 1024*1024
+
+    def copy(self, src_server, src_path, dst_server, dst_path, dst_rel_path=None):
+        # computes the checksum of the data as it is written
+        checksum = zlib.adler32(b"")
+        try:
+            with open(src_path, "rb") as src, open(dst_path, "wb") as dst:
+                while True:
+                    data = src.read(self.BufferSize)
+                    if not data:
+                        break
+                    dst.write(data)
+                    checksum = zlib.adler32(data, checksum)
+        except OSError as e:
+            raise StorageError(f"copy {src_path} -> {dst_path} failed: {e}")
+        return "%08x" % (checksum,)
+
+    def checksum(self, server, path):
+        checksum = zlib.adler32(b"")
+        try:
+            with open(path, "rb") as f:
+                while True:
+                    data = f.read(self.BufferSize)
+                    if not data:
+                        break
+                    checksum = zlib.adler32(data, checksum)
+        except OSError as e:
+            raise StorageError(f"checksum {path} failed: {e}")
+        return "%08x" % (checksum,)
+
+    def remove(self, server, path):
+        try:
+            os.remove(path)
+        except OSError as e:
+            raise StorageError(f"rm {path} failed: {e}")
+
+    def rename(self, server, src_path, dst_path):
+        try:
+            os.rename(src_path, dst_path)
+        except OSError as e:
+            raise StorageError(f"mv {src_path} {dst_path} failed: {e}")
+
+    def read(self, server, path, max_size=None):
+        try:
+            with open(path, "rb") as f:
+                data = f.read() if max_size is None else f.read(max_size + 1)
+        except OSError as e:
+            raise StorageError(f"read {path} failed: {e}")
+        if max_size is not None and len(data) > max_size:
+            raise StorageError(f"{path} size exceeds {max_size} bytes")
+        return data
+
+class DirectoryCache(Logged):
+    """
+    Bounded cache of directories known to exist, shared by the movers to skip redundant mkdir calls.
+    Filled by successful mkdir and copy operations, the entry is dropped when a copy into the directory
+    fails because the directory does not exist.
+    """
+
+    DefaultSize = 100000
+    DefaultTTL = 24*3600
+
+    def __init__(self, config):
+        # config is the "dir_cache" section of the declad configuration
+        Logged.__init__(self, "DirectoryCache")
+        self.Known = ExpiringCache(config.get("size", self.DefaultSize), config.get("ttl", self.DefaultTTL), name="DirectoryCache")
+        self.WarmUpDepth = config.get("warm_up_depth", 0)
+
+    def exists(self, server, path):
+        return (server, path.rstrip("/")) in self.Known
+
+    def add(self, server, path):
+        self.Known.add((server, path.rstrip("/")))
+
+    def remove(self, server, path):
+        self.Known.remove((server, path.rstrip("/")))
+
+    def warm_up(self, backend, server, root):
+        # lists the directory tree under root down to the configured depth and remembers the directories found
+        n = 0
+        level = [root.rstrip("/")]
+        for _ in range(self.WarmUpDepth):
+            next_level = []
+            for location in level:
+                try:
+                    _, dirs = backend.ls(server, location)
+                except StorageError as e:
+                    self.log(f"warm-up: error listing {location}: {e}")
+                    continue
+                for path in dirs:
+                    self.add(server, path)
+                next_level += dirs
+            n += len(next_level)
+            level = next_level
+        self.log(f"warm-up: {n} directories found under {root}")
+        return n
+
+def is_missing_directory(error):
+    # whether the StorageError reported by the copy means the destination directory does not exist
+    message = str(error).lower()
+    return "no such file or directory" in message or "no such directory" in message
+
+def directory_cache(config):
+    # returns the process-wide directory cache or None if it is disabled with dir_cache.size = 0
+    cache_config = config.get("dir_cache") or {}
+    if cache_config.get("size", DirectoryCache.DefaultSize) <= 0:
+        return None
+    return shared(("dir_cache",), lambda: DirectoryCache(cache_config))
+
+class DestinationState(Primitive, Logged):
+    """
+    Answers "does the destination file exist and what is its size" from directory listings shared by the movers.
+    Each directory is listed at most once per TTL. Concurrent requests for the same directory wait for
+    the same listing. Successful copies update the cached listing.
+
+    This pays off only when many files go to the same destination directories. With a layout which spreads the files
+    over many directories, e.g. the hash-based one, a directory listing per file costs more than a stat per file,
+    so this is used only if enabled in the configuration.
+    """
+
+    DefaultSize = 10000
+    DefaultTTL = 300
+    DefaultTimeout = 10
+
+    def __init__(self, backend, config, dir_cache=None):
+        # config is the "dest_state" section of the declad configuration
+        Primitive.__init__(self, name="DestinationState")
+        Logged.__init__(self, "DestinationState")
+        self.Backend = backend
+        self.DirCache = dir_cache
+        self.Listings = ExpiringCache(config.get("cache_size", self.DefaultSize), config.get("ttl", self.DefaultTTL), name="DestinationListings")
+        self.Pending = {}           # (server, directory) -> Promise
+        self.Timeout = config.get("timeout", self.DefaultTimeout)
+        self.ListingConfig = None
+        if isinstance(backend, CommandStorage):
+            if "ls_command_template" not in config:
+                raise ValueError("dest_state.ls_command_template is required with the command storage backend")
+            self.ListingConfig = dict(
+                ls_command_template = config["ls_command_template"],
+                parse_re = config.get("parse_re", XRootDScanner.DefaultParseRE),
+                max_parse_errors = config.get("max_parse_errors", XRootDScanner.DefaultMaxParseErrors)
+            )
+
+    def listing(self, server, directory):
+        # returns {name: size} or None if the directory does not exist
+        key = (server, directory.rstrip("/"))
+        with self:
+            listing = self.Listings.get(key, self)
+            if listing is not self:
+                return listing
+            promise = self.Pending.get(key)
+            owner = promise is None
+            if owner:
+                promise = self.Pending[key] = Promise()
+        if not owner:
+            return promise.wait()
+        try:
+            try:
+                files, _ = self.Backend.ls(server, directory, self.Timeout, self.ListingConfig)
+                listing = {f.Name: f.Size for f in files}
+            except StorageError as e:
+                if not is_missing_directory(e):
+                    raise
+                listing = None
+            self.Listings.set(key, listing)
+            if listing is not None and self.DirCache is not None:
+                self.DirCache.add(server, directory)
+            promise.complete(listing)
+            return listing
+        except:
+            promise.exception(*sys.exc_info())
+            raise
+        finally:
+            with self:
+                del self.Pending[key]
+
+    def size(self, server, path):
+        # returns file size or None if the file does not exist
+        directory, name = path.rsplit("/", 1)
+        listing = self.listing(server, directory)
+        return None if listing is None else listing.get(name)
+
+    @synchronized
+    def update(self, server, path, size):
+        # records the file copied to the destination. Creates the listing for a newly created directory
+        directory, name = path.rsplit("/", 1)
+        key = (server, directory.rstrip("/"))
+        listing = self.Listings.get(key, self)
+        if listing is not self:
+            listing = dict(listing or {})
+            listing[name] = size
+            self.Listings.set(key, listing)
+
+    def invalidate(self, server, directory):
+        self.Listings.remove((server, directory.rstrip("/")))
+
+def destination_state(config):
+    # returns the process-wide destination state service or None unless it is enabled with dest_state.enabled = true
+    state_config = config.get("dest_state") or {}
+    if not state_config.get("enabled", False):
+        return None
+    key = ("dest_state", backend_key(config), config_key(state_config))
+    return shared(key, lambda: DestinationState(backend(config), state_config, directory_cache(config)))
+
+Backends = {
+    "command":  CommandStorage,
+    "xrootd":   XRootDStorage,
+    "local":    LocalStorage
+}
+
+def config_key(value):
+    # hashable form of a configuration value
+    return json.dumps(value, sort_keys=True, default=str)
+
+def backend_key(config):
+    storage_type = config.get("storage", {}).get("type", "command")
+    if storage_type not in Backends:
+        raise ValueError(f"Unknown storage type: {storage_type}. Accepted: " + ", ".join(Backends.keys()))
+    return (storage_type,) + tuple(config_key(config.get(name)) for name in Backends[storage_type].ConfigKeys)
+
+def backend(config):
+    # returns the storage backend configured in the "storage" section. Default: "command".
+    # Sources configured with the same storage settings share the backend
+    key = backend_key(config)
+    return shared(("storage",) + key, lambda: Backends[key[0]](config))
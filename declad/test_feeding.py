@@ -0,0 +1,70 @@
+import getopt, sys, os, json, time, zlib, tempfile, shutil
+
+Usage = """
+python test_feeding.py [-p <prefetch workers>] [<size> ...]
+    -p <prefetch workers>   - default 5, 0 - no metadata prefetching
+    <size> ...              - file sizes, default: 100 500 400 300 200
+
+Moves the files between local directories with a single worker per stage and feeding.order: smallest,
+and checks that they are moved in the order of their sizes
+"""
+
+opts, args = getopt.getopt(sys.argv[1:], "p:h?")
+opts = dict(opts)
+if "-h" in opts or "-?" in opts:
+    print(Usage)
+    sys.exit(2)
+
+sizes = [int(a) for a in args] or [100, 500, 400, 300, 200]
+prefetch_workers = int(opts.get("-p", 5))
+
+import logs
+logs.init("-", error_out="-")
+import historydb
+from mover import Manager
+from file_descriptor import FileDescriptor
+
+root = tempfile.mkdtemp(prefix="test_feeding_")
+src, dst = root + "/src", root + "/dst"
+os.makedirs(src)
+os.makedirs(dst)
+
+files = {}
+for i, size in enumerate(sizes):
+    name = f"file_{i:03d}.dat"
+    data = os.urandom(size)
+    with open(src + "/" + name, "wb") as f:
+        f.write(data)
+    meta = {"checksum": "%08x" % zlib.adler32(data), "file_size": size, "runs": [[i, 1, "test"]], "file_type": "test"}
+    with open(src + "/" + name + ".json", "w") as f:
+        f.write(json.dumps(meta))
+    files[name] = FileDescriptor("local", src, src + "/" + name, size)
+
+config = {
+    "storage": {"type": "local"},
+    "source_server": "local", "destination_server": "local",
+    "source_root_path": src, "destination_root_path": dst,
+    "rucio": {"declare_to_rucio": False},
+    "max_movers": 1, "stagger": 0.0,
+    "default_category": "test",
+    "persist_state": False,
+    "feeding": {"order": "smallest"},
+    "prefetch": {"workers": prefetch_workers},
+}
+
+manager = Manager(config, historydb.open(root + "/history.sqlite"))
+manager.add_files(files)
+
+t1 = time.time() + 30
+while time.time() < t1 and not all(task.Ended for task in manager.RecentTasks.values()):
+    time.sleep(0.1)
+
+tasks = sorted(manager.RecentTasks.values(), key=lambda task: task.Ended or t1)
+moved = [task.FileDesc.Size for task in tasks if task.Ended and not task.Failed]
+shutil.rmtree(root, ignore_errors=True)
+
+print("moved in order:", moved)
+if moved != sorted(sizes):
+    print("FAILED: expected", sorted(sizes))
+    sys.exit(1)
+print("OK")
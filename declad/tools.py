@@ -1,4 +1,39 @@
-from pythreader import ShellCommand
+from pythreader import ShellCommand, TaskQueue, version_info as pythreader_version_info
+import subprocess, threading, tempfile
+
+class FIFOTaskQueue(TaskQueue):
+    #
+    # pythreader TaskQueue.append() inserts the task at the head of the queue, so the tasks start in LIFO order.
+    # This queue starts them in the order they were added.
+    #
+    # append() reuses the private TaskQueue.__add(mode, task, ...) of pythreader 2.15.x, the only way to put
+    # a task at the tail of the queue with its promise and repeat parameters set up. The version is checked
+    # below, so that a pythreader upgrade fails here instead of silently changing the order.
+    #
+
+    PythreaderVersions = ((2,15,0), (2,16,0))       # [min, max)
+
+    def append(self, task, *params, **args):
+        return self._TaskQueue__add("append", task, *params, **args)
+
+    add = addTask = append
+
+    def resize(self, nworkers, capacity=None):
+        # changes the number of workers at run time and, if capacity is not None, the number of tasks the queue
+        # can hold, running and waiting, before append() blocks. Appends blocked on the old capacity are woken up
+        # and the waiting tasks start if there are free workers now
+        if capacity is not None:
+            tasks = self.Queue              # pythreader DEQueue
+            with tasks:
+                tasks.Capacity = capacity
+                tasks.wakeup()
+        self.NWorkers = nworkers
+        self.start_tasks()
+
+vmin, vmax = FIFOTaskQueue.PythreaderVersions
+if not (vmin <= pythreader_version_info < vmax) or not hasattr(TaskQueue, "_TaskQueue__add"):
+    raise ModuleNotFoundError("FIFOTaskQueue requires pythreader version >= %s and < %s, found %s" % (
+        ".".join(map(str, vmin)), ".".join(map(str, vmax)), ".".join(map(str, pythreader_version_info))))
 
 def to_bytes(s):    
     return s if isinstance(s, bytes) else s.encode("utf-8")
@@ -23,6 +58,91 @@ def runCommand(cmd, timeout=None, debug=None):
     
     return status, out
 
+def readCommandOutput(cmd, max_size=None, timeout=None, debug=None):
+    #
+    # Runs the command and reads its stdout into memory, up to max_size bytes.
+    # Returns (status, stdout bytes, stderr text)
+    #
+    if timeout is not None and timeout < 0: timeout = None
+    if debug:
+        debug("readCommandOutput: %s" % (cmd,))
+    with tempfile.TemporaryFile() as err_file:              # stderr is not read until the end, so it can not block the command
+        p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=err_file)
+        timer = None
+        timed_out = []
+        if timeout is not None:
+            def kill():
+                timed_out.append(True)
+                p.kill()
+            timer = threading.Timer(timeout, kill)
+            timer.daemon = True
+            timer.start()
+        try:
+            out = p.stdout.read() if max_size is None else p.stdout.read(max_size + 1)
+            too_large = max_size is not None and len(out) > max_size
+            if too_large:
+                p.kill()
+            p.stdout.close()
+            status = p.wait()
+        finally:
+            if timer is not None:
+                timer.cancel()
+        err_file.seek(0)
+        err = to_str(err_file.read())
+    if timed_out:
+        return 100, out, err + "\n subprocess timed out\n"
+    if too_large:
+        return 101, out[:max_size], err + "\n output exceeds %d bytes\n" % (max_size,)
+    return status, out, err
+
+class CommandError(Exception):
+
+    def __init__(self, cmd, status, error):
+        Exception.__init__(self, f"Command {cmd} failed with status {status}: {error}")
+        self.Status = status
+        self.Error = error
+
+def iterCommandLines(cmd, timeout=None, debug=None):
+    #
+    # Runs the command and yields lines of its stdout as they arrive, without the trailing newline.
+    # Raises CommandError after the last line if the command failed or timed out
+    #
+    if timeout is not None and timeout < 0: timeout = None
+    if debug:
+        debug("iterCommandLines: %s" % (cmd,))
+    with tempfile.TemporaryFile() as err_file:              # stderr is not read until the end, so it can not block the command
+        p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=err_file, 
+                    universal_newlines=True, errors="ignore")
+        timer = None
+        timed_out = []
+        if timeout is not None:
+            def kill():
+                timed_out.append(True)
+                p.kill()
+            timer = threading.Timer(timeout, kill)
+            timer.daemon = True
+            timer.start()
+        try:
+            for line in p.stdout:
+                yield line.rstrip("\n")
+            p.stdout.close()
+            status = p.wait()
+        finally:
+            if timer is not None:
+                timer.cancel()
+            if p.poll() is None:
+                # the caller stopped reading
+                p.kill()
+                p.wait()
+        if timed_out:
+            status = 100
+        if status:
+            err_file.seek(0)
+            err = to_str(err_file.read())
+            if timed_out:
+                err += "\n subprocess timed out\n"
+            raise CommandError(cmd, status, err)
+
 if __name__ == '__main__':
 
 	command="xrdfs eospublic.cern.ch ls -l /eos/experiment/neutplatform/protodune/scratchdisk/daq/data"
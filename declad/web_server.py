@@ -38,9 +38,16 @@ class Handler(WPHandler):
         files, error = self.App.ls_input()
         if files:
             files = sorted(files, key=lambda d: d.Name)
-        server, location = self.App.input_location()
         return self.render_to_response("input_files.html", files=files, error=error,
-            server=server, location=location)
+            sources=self.App.scan_sources())
+
+    def scanner(self, request, relpath, **args):
+        return self.render_to_response("scanner.html", sources=self.App.scan_sources(), now=time.time())
+
+    def concurrency(self, request, relpath, **args):
+        controller = self.App.concurrency_controller()
+        return self.render_to_response("concurrency.html", controller=controller,
+            decisions=reversed(controller.decisions()) if controller is not None else [])
 
     def config(self, request, relpath, **args):
         return self.render_to_response("config.html", 
@@ -151,7 +158,21 @@ class Handler(WPHandler):
         }
 
         return json.dumps(out), "text/json"
-        
+
+    def scanner_log(self, req, rel_path, since_t=None, source=None, **args):
+        # per-scan metrics, grouped by source
+        tmin = self.decode_time(since_t)
+        records = {}
+        for r in self.App.HistoryDB.scannerHistorySince(tmin, source or None):
+            records.setdefault(r.source, []).append(r.as_dict())
+        out = {
+            "tmin":     tmin,
+            "tmax":     time.time(),
+            "sources":  sorted(records.keys()),
+            "records":  records
+        }
+        return json.dumps(out), "text/json"
+
 
 
 def as_dt_utc(t):
@@ -230,8 +251,8 @@ class App(WPApp):
     def ls_input(self):
         return self.Manager.ls_input()
 
-    def input_location(self):
-        return self.Manager.input_location()
+    def scan_sources(self):
+        return self.Manager.scan_sources()
         
     def recent_transfers(self):
         return self.Manager.recent_tasks()
@@ -239,6 +260,9 @@ class App(WPApp):
     def task(self, name):
         return self.Manager.task(name)
 
+    def concurrency_controller(self):
+        return self.Manager.concurrency_controller()
+
     def config(self):
         return self.Manager.Config
     
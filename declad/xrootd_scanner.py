@@ -1,6 +1,6 @@
 from pythreader import PyThread, synchronized, Primitive
 from threading import Event
-from tools import runCommand
+from tools import runCommand, iterCommandLines, CommandError
 import time, fnmatch, re
 from logs import Logged
 from file_descriptor import FileDescriptor
@@ -13,6 +13,8 @@ class XRootDScanner(Logged):
     # generic xrootd server
     DefaultParseRE = r"^(?P<type>[a-z-])\S+\s+\S+\s+\S+\s+(?P<size>\d+)\s+\d{4}-\d{2}-\d{2}\s+\d{2}:\d{2}:\d{2}\s+(?P<path>\S+)$"
 
+    DefaultMaxParseErrors = 100
+
     def __init__(self, server, config):
         Logged.__init__(self, f"XRootDScanner")
         self.Recursive = False
@@ -20,6 +22,7 @@ class XRootDScanner(Logged):
         self.lsCommandTemplate = config["ls_command_template"].replace("$server", self.Server)                
         self.ParseRE = re.compile(config["parse_re"])
         self.OperationTimeout = config.get("timeout", 30)
+        self.MaxParseErrors = config.get("max_parse_errors", self.DefaultMaxParseErrors)
                 
     def scan(self, location):
         status, error, file_descs, _ = self.listFilesAndDirs(location, self.OperationTimeout)
@@ -28,36 +31,52 @@ class XRootDScanner(Logged):
         else:
             raise RuntimeError("Error scanning %s: status=%s error=%s" % (location, status, error))
 
-    def listFilesAndDirs(self, location, timeout):
+    def iterFilesAndDirs(self, location, timeout):
+        #
+        # Reads the listing line by line and yields FileDescriptor for each file and path for each directory.
+        # Raises CommandError if the ls command fails and ScannerError if too many lines can not be parsed
+        #
         lscommand = self.lsCommandTemplate.replace("$location", location)
+        nerrors = 0
+        for l in iterCommandLines(lscommand, timeout, self.debug):
+            l = l.strip()
+            if l:
+                m = self.ParseRE.match(l)
+                if m:
+                    t = m["type"]
+                    path = m["path"]
+                    if t in "f-":
+                        size = int(m["size"])
+                        if size == 0:
+                            self.debug("Zero file size in:\n   ", l)
+                        path = path if path.startswith(location) else location + "/" + path
+                        yield FileDescriptor(self.Server, location, path, size)
+                    elif t == "d": 
+                        path = path if path.startswith(location) else location + "/" + path
+                        yield path
+                    else:
+                        self.log(f"Unknown directory entry type '{t}' in: {l} -- ignored")
+                else:
+                    nerrors += 1
+                    if nerrors > self.MaxParseErrors:
+                        raise ScannerError(f"More than {self.MaxParseErrors} lines can not be parsed in the output of {lscommand}. Last: {l}")
+
+    def listFilesAndDirs(self, location, timeout):
         files = []
         dirs = []
-        error = ""
-        status, out = runCommand(lscommand, timeout, self.debug)
-        if status:
-            error = out
-            self.log("Error in ls (%s): %s" % (lscommand, error,))
-        else:
-            lines = [x.strip() for x in out.split("\n")]
-            for l in lines:
-                l = l.strip()
-                if l:
-                    m = self.ParseRE.match(l)
-                    if m:
-                        t = m["type"]
-                        path = m["path"]
-                        if t in "f-":
-                            size = int(m["size"])
-                            if size == 0:
-                                self.debug("Zero file size in:\n   ", l)
-                            path = path if path.startswith(location) else location + "/" + path
-                            files.append(FileDescriptor(self.Server, location, path, size))
-                        elif t == "d": 
-                            path = path if path.startswith(location) else location + "/" + path
-                            dirs.append(path)
-                        else:
-                            print(f"Unknown directory entry type '{t}' in: {l} -- ignored")
-        return status, error, files, dirs
+        try:
+            for item in self.iterFilesAndDirs(location, timeout):
+                if isinstance(item, FileDescriptor):
+                    files.append(item)
+                else:
+                    dirs.append(item)
+        except CommandError as e:
+            self.log("Error in ls:", e)
+            return e.Status, e.Error, [], []
+        except ScannerError as e:
+            self.log("Error in ls:", e)
+            return 1, str(e), [], []
+        return 0, "", files, dirs
         
     def getFileSize(self, file_path):
         stat_command = f"xrdfs {self.Server} stat {file_path}"